@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Benchmark generation of an apt dist's Packages index
+
+Compares the old approach (decode every package's fields and render the whole index on every regen) against
+assembling the index from stanzas stored at upload time, and against appending a single new upload to an existing
+index.
+
+    python3 bench/apt_regen.py -n 10000
+"""
+
+import json
+import os
+import sqlalchemy
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from repobot.aptprovider import AptProvider, AptRepo, AptDist, AptIndex, AptPackage, algos, \
+    render_stanza  # NOQA: E402
+from repobot.tables import Base  # NOQA: E402
+
+
+def legacy_packages(session, dist):
+    """
+    Packages generation as it was done before stanzas were stored
+    """
+    str_packages = ""
+    for package in session.query(AptPackage) \
+            .filter(AptPackage.repo == dist.repo,
+                    AptPackage.dist == dist) \
+            .order_by(AptPackage.id).all():
+        fields = json.loads(package.fields)
+        for k, v in fields.items():
+            str_packages += "{}: {}\n".format(k, v)
+        for algo, algoname in algos.items():
+            str_packages += "{}: {}\n".format(algoname, getattr(package, algo))
+        str_packages += "Filename: packages/{}/{}/{}\n".format(dist.name, package.fname[0], package.fname)
+        str_packages += "Size: {}\n".format(package.size)
+        str_packages += "\n"
+    return str_packages
+
+
+def make_package(repo, dist, i):
+    name = "package{}".format(i)
+    fname = "{}_1.0.{}_amd64.deb".format(name, i)
+    fields = {"Package": name,
+              "Version": "1.0.{}".format(i),
+              "Architecture": "amd64",
+              "Maintainer": "Benchmark <bench@localhost>",
+              "Installed-Size": "1024",
+              "Depends": "libc6 (>= 2.17), python3 (>= 3.6)",
+              "Section": "misc",
+              "Priority": "optional",
+              "Description": "synthetic package {}\n a longer description of the package".format(i)}
+    hashes = {"md5": "{:032x}".format(i), "sha1": "{:040x}".format(i),
+              "sha256": "{:064x}".format(i), "sha512": "{:0128x}".format(i)}
+    return AptPackage(repo=repo, dist=dist, component="main", name=name, version=fields["Version"], arch="amd64",
+                      fname=fname, size=4096 + i, fields=json.dumps(fields),
+                      stanza=render_stanza(fields, hashes, "packages/{}/{}/{}".format(dist.name, fname[0], fname),
+                                           4096 + i),
+                      **hashes)
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="apt Packages index generation benchmark")
+    parser.add_argument('-n', '--packages', default=10000, type=int, help="number of packages in the dist")
+    parser.add_argument('-d', '--database', default="sqlite://", help="database connection string")
+    args = parser.parse_args()
+
+    engine = sqlalchemy.create_engine(args.database)
+    Base.metadata.create_all(engine)
+    session = sqlalchemy.orm.sessionmaker(bind=engine)()
+
+    repo = AptRepo(name="bench")
+    dist = AptDist(name="bionic", repo=repo)
+    index = AptIndex(dist=dist, component="main", arch="amd64")
+    session.add_all([repo, dist, index])
+    session.add_all([make_package(repo, dist, i) for i in range(args.packages)])
+    session.commit()
+
+    # the provider is only used for its index building methods
+    provider = AptProvider.__new__(AptProvider)
+
+    results = {}
+    results["legacy full render"] = timed(lambda: legacy_packages(session, dist))
+    results["stored stanzas, full assembly"] = timed(lambda: provider._build_packages(session, index))
+    session.commit()
+    legacy = legacy_packages(session, dist)
+    assert index.packages == legacy, "assembled index differs from the legacy render"
+
+    session.add(make_package(repo, dist, args.packages))
+    session.commit()
+    results["stored stanzas, append one upload"] = timed(lambda: provider._build_packages(session, index))
+    session.commit()
+
+    print("{} packages, {} byte index".format(args.packages, len(index.packages)))
+    for name, duration in results.items():
+        print("{:40} {:10.2f} ms".format(name, duration * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Benchmark hashing of uploaded packages
+
+Compares the old approach (4KB reads, each digest updated one after another) against large reads with the digests
+updated one after another, and against the ingest module's MultiHasher which runs each digest on its own thread.
+Measured with the four digests apt packages need and with the single sha256 of wheels and tarballs.
+
+    python3 bench/ingest_hash.py -s 1024
+"""
+
+import hashlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from repobot.aptprovider import algos  # NOQA: E402
+from repobot.ingest import READ_CHUNK, copyhash  # NOQA: E402
+
+
+class RepeatReader(object):
+    """
+    File-like source of `size` bytes made of `block` repeated, without holding all of it in memory
+    """
+    def __init__(self, size, block):
+        self.block = block
+        self.remaining = size
+        self.pos = 0
+
+    def read(self, n):
+        n = min(n, self.remaining, len(self.block) - self.pos)
+        self.remaining -= n
+        data = self.block[self.pos:self.pos + n]
+        self.pos = (self.pos + n) % len(self.block)
+        return data
+
+
+def legacy_copyhash(fin, algos):
+    """
+    Hashing as it was done before the ingest module
+    """
+    hashes = {algo: getattr(hashlib, algo)() for algo in algos}
+    while True:
+        data = fin.read(4096)
+        if not data:
+            break
+        for h in hashes.values():
+            h.update(data)
+    return {k: v.hexdigest() for k, v in hashes.items()}
+
+
+def sequential_copyhash(fin, algos):
+    hashes = {algo: getattr(hashlib, algo)() for algo in algos}
+    while True:
+        data = fin.read(READ_CHUNK)
+        if not data:
+            break
+        for h in hashes.values():
+            h.update(data)
+    return {k: v.hexdigest() for k, v in hashes.items()}
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="upload hashing benchmark")
+    parser.add_argument('-s', '--size', default=1024, type=int, help="megabytes of input to hash")
+    args = parser.parse_args()
+    size = args.size * 1024 * 1024
+    block = os.urandom(READ_CHUNK)
+
+    methods = {"legacy 4KB reads": legacy_copyhash,
+               "1MB reads, sequential digests": sequential_copyhash,
+               "1MB reads, threaded digests": lambda fin, algos: copyhash(fin, [], algos)[0]}
+
+    print("{} MB input".format(args.size))
+    for label, algoset in (("md5+sha1+sha256+sha512", list(algos.keys())), ("sha256", ["sha256"])):
+        digests = []
+        for name, method in methods.items():
+            duration, result = timed(lambda: method(RepeatReader(size, block), algoset))
+            digests.append(result)
+            print("{:24} {:32} {:10.1f} MB/s".format(label, name, args.size / duration))
+        assert all(d == digests[0] for d in digests), "methods disagree on the digests"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Count the database queries made by the hot read endpoints
+
+Each endpoint is requested against a small and a large repo. The number of queries it makes must not grow with the
+size of the repo, which would point at a lazy load per row, and must stay within the endpoint's budget once the repo
+has been requested before. Exits non-zero if either is exceeded, so it can be run as a regression check.
+
+    python3 bench/read_queries.py -n 2000
+"""
+
+import cherrypy
+import os
+import sqlalchemy
+import sys
+import time
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from repobot.aptprovider import AptProvider, AptWeb, AptRepo, AptDist, AptIndex, AptIndexFile, \
+    AptPackage  # NOQA: E402
+from repobot.blobs import BlobStore  # NOQA: E402
+from repobot.cache import LRUCache  # NOQA: E402
+from repobot.pypiprovider import PypiProvider, PipWeb, PipRepo, PipPackage, PipProject  # NOQA: E402
+from repobot.tables import Base  # NOQA: E402
+from repobot.tarprovider import TarProvider, TarWeb, TarRepo, TarPackage, TarProject  # NOQA: E402
+
+
+"""most queries each endpoint may make"""
+BUDGETS = {"apt repo page": 2,
+           "apt pubkey": 1,
+           "apt Packages": 1,
+           "apt by-hash": 1,
+           "apt Release": 1,
+           "apt install": 2,
+           "apt dist listing": 2,
+           "apt package download": 1,
+           "pypi root": 1,
+           "pypi repo page": 2,
+           "pypi project page": 2,
+           "pypi download": 1,
+           "tar root": 1,
+           "tar repo page": 2,
+           "tar package page": 2,
+           "tar download": 1}
+
+
+class QueryCounter(object):
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self.executed)
+
+    def executed(self, *args):
+        self.count += 1
+
+
+def fill(session, name, size):
+    """
+    Add a repo of `size` packages to each provider's tables
+    """
+    hashes = lambda i: {"md5": "{:032x}".format(i), "sha1": "{:040x}".format(i),  # NOQA: E731
+                        "sha256": "{:064x}".format(i), "sha512": "{:0128x}".format(i)}
+
+    repo = AptRepo(name=name, gpgpubkey="pubkey")
+    dist = AptDist(repo=repo, name="bionic", release_cache="Release", sig_cache="sig", inrelease_cache="InRelease")
+    session.add_all([repo, dist, AptIndex(dist=dist, component="main", arch="amd64", packages="")])
+    session.flush()
+    session.add(AptIndexFile(dist_id=dist.id, path="main/binary-amd64/Packages", size=9, data=b"Package: ",
+                             **hashes(0)))
+    session.add_all([AptPackage(repo=repo, dist=dist, name="package{}".format(i), version="1.0.{}".format(i),
+                                arch="amd64", fname="package{}_1.0.{}_amd64.deb".format(i, i), size=i, fields="{}",
+                                **hashes(i)) for i in range(size)])
+
+    repo = PipRepo(name=name)
+    session.add(repo)
+    session.add_all([PipPackage(repo=repo, dist="dist{}".format(i % 10), dist_norm="dist{}".format(i % 10),
+                                version="1.0.{}".format(i), python="py3", api="none", platform="any",
+                                fname="dist{}-1.0.{}-py3-none-any.whl".format(i % 10, i), size=i,
+                                sha256=hashes(i)["sha256"], fields="{}") for i in range(size)])
+    session.add_all([PipProject(repo=repo, dist="dist{}".format(i), dist_norm="dist{}".format(i),
+                                count=size // 10, latest="1.0") for i in range(10)])
+
+    repo = TarRepo(name=name)
+    session.add(repo)
+    session.add_all([TarPackage(repo=repo, name="tar{}".format(i % 10), version="1.0.{}".format(i),
+                                fname="tar{}-1.0.{}.tar.gz".format(i % 10, i), size=i, sha256=hashes(i)["sha256"])
+                     for i in range(size)])
+    session.add_all([TarProject(repo=repo, name="tar{}".format(i), count=size // 10, latest="1.0") for i in range(10)])
+    session.commit()
+
+
+def endpoints(apt, pypi, tar, name):
+    """
+    Return label -> (method, callable requesting the endpoint) for the repo `name`
+    """
+    return {"apt repo page": ("GET", lambda: apt.index(name)),
+            "apt pubkey": ("GET", lambda: apt.pubkey(name)),
+            "apt Packages": ("GET", lambda: apt.dists("bionic", "main", "binary-amd64", "Packages", reponame=name)),
+            "apt by-hash": ("GET", lambda: apt.dists("bionic", "main", "binary-amd64", "by-hash", "SHA256",
+                                                     "{:064x}".format(0), reponame=name)),
+            "apt Release": ("GET", lambda: apt.dists("bionic", "Release", reponame=name)),
+            "apt install": ("GET", lambda: apt.dists("bionic", "install", reponame=name)),
+            "apt dist listing": ("GET", lambda: apt.dists("bionic", reponame=name)),
+            "apt package download": ("GET", lambda: apt.packages("bionic", "p", "package1_1.0.1_amd64.deb",
+                                                                 reponame=name)),
+            "pypi root": ("GET", lambda: pypi.index()),
+            "pypi repo page": ("GET", lambda: pypi.index(name)),
+            "pypi project page": ("GET", lambda: pypi.index(name, "dist1")),
+            "pypi download": ("HEAD", lambda: pypi.index(name, "dist1", "dist1-1.0.1-py3-none-any.whl")),
+            "tar root": ("GET", lambda: tar.index()),
+            "tar repo page": ("GET", lambda: tar.index(name)),
+            "tar package page": ("GET", lambda: tar.index(name, "tar1")),
+            "tar download": ("HEAD", lambda: tar.index(name, "tar1", "tar1-1.0.1.tar.gz"))}
+
+
+def request(session, counter, method, func):
+    """
+    Call an endpoint as cherrypy would for a fresh request, and return the number of queries it made and its duration
+    """
+    cherrypy.serving.request = cherrypy._cprequest.Request(None, None)
+    cherrypy.serving.response = cherrypy._cprequest.Response()
+    cherrypy.request.method = method
+    cherrypy.request.headers["Host"] = "localhost"
+    cherrypy.request.db = cherrypy.request.db_primary = session
+    session.expire_all()
+
+    counter.count = 0
+    start = time.perf_counter()
+    body = func()
+    if not isinstance(body, (str, bytes)):
+        body = list(body)  # streamed responses query before returning, so that the session can be closed
+    return counter.count, time.perf_counter() - start
+
+
+def providers():
+    """
+    Build the providers' web roots without mounting them or starting their background work. Metadata caches are
+    disabled so that every request reaches the database.
+    """
+    blobs = BlobStore(None, "bench", mode="accel")
+
+    apt = AptProvider.__new__(AptProvider)
+    apt.basepath = "data/provider/apt"
+    apt.blobs = blobs
+    apt.cache = LRUCache(0)
+    apt.generations = {}
+    apt.regen_dist = lambda *args: None
+
+    pypi = PypiProvider.__new__(PypiProvider)
+    pypi.basepath = "data/provider/pypi"
+    pypi.blobs = blobs
+    pypi.cache = LRUCache(0)
+    pypi.synced = set()
+
+    tar = TarProvider.__new__(TarProvider)
+    tar.basepath = "data/provider/tar"
+    tar.blobs = blobs
+    tar.synced = set()
+
+    return AptWeb(apt), PipWeb(pypi), TarWeb(tar)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="hot read endpoint query counts")
+    parser.add_argument('-n', '--packages', default=2000, type=int, help="number of packages in the large repos")
+    parser.add_argument('-d', '--database', default="sqlite://", help="database connection string")
+    args = parser.parse_args()
+
+    engine = sqlalchemy.create_engine(args.database)
+    Base.metadata.create_all(engine)
+    session = sqlalchemy.orm.sessionmaker(bind=engine)()
+    fill(session, "small", 20)
+    fill(session, "large", args.packages)
+
+    counter = QueryCounter(engine)
+    apt, pypi, tar = providers()
+    small = endpoints(apt, pypi, tar, "small")
+    large = endpoints(apt, pypi, tar, "large")
+
+    failed = False
+    print("{:24} {:>8} {:>8} {:>8} {:>12}".format("endpoint", "small", "large", "budget", "large ms"))
+    for label, budget in BUDGETS.items():
+        # the first request for a repo may do one-off work, such as syncing its project rows
+        request(session, counter, *small[label])
+        request(session, counter, *large[label])
+        small_count, _ = request(session, counter, *small[label])
+        large_count, duration = request(session, counter, *large[label])
+        ok = small_count == large_count and large_count <= budget
+        failed = failed or not ok
+        print("{:24} {:8} {:8} {:8} {:12.2f}{}".format(label, small_count, large_count, budget, duration * 1000,
+                                                       "" if ok else "  FAIL"))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
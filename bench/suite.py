@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+"""
+Benchmark the server end to end
+
+Starts the server, with all three providers, against a local S3 stand-in and a database, uploads synthetic repos to it
+and measures:
+
+- upload throughput of debs, wheels and tarballs
+- batch uploads of a whole repo in one request, until apt's metadata has been regenerated
+- apt regen time, of a whole dist and after a single upload
+- simple index latency, of repo and project pages
+- package download throughput
+
+Uploads, index requests and downloads are each run at every --concurrency level. Results are written as json to
+--output, and if --baseline names the results of an earlier run they are compared against it; the exit status is
+non-zero if any result is worse than the baseline by more than --tolerance.
+
+The S3 stand-in is moto's server (pip install 'moto[server]') by default, or a minio binary with --s3-server minio, or
+any S3 service given with --s3. The database is a fresh SQLite file by default; pass a mysql+pymysql:// url with
+--database to benchmark against MySQL. Repos are named after the run, so a database can be reused between runs, but it
+should not be one holding real repos.
+
+    python3 bench/suite.py -n 50 --size 256 --concurrency 1,4,16 -o results.json
+    python3 bench/suite.py -n 50 --size 256 --concurrency 1,4,16 --baseline results.json
+"""
+
+import base64
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import re
+import requests
+import shutil
+import socket
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+
+APPROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+S3_KEY = "benchkey"
+S3_SECRET = "benchsecret"
+BUCKET = "bench"
+
+"""result fields, and whether a larger value is better, used when comparing against a baseline"""
+MEASURES = {"mb_per_s": True,
+            "req_per_s": True,
+            "p50_ms": False,
+            "p95_ms": False,
+            "p99_ms": False,
+            "seconds": False}
+
+
+def payload(seed, size):
+    """
+    Return `size` bytes that are the same for the same `seed` on every run
+    """
+    return random.Random(seed).getrandbits(size * 8).to_bytes(size, "little") if size else b""
+
+
+def ar_member(name, data):
+    header = "{:<16}{:<12}{:<6}{:<6}{:<8}{:<10}`\n".format(name, 0, 0, 0, 100644, len(data)).encode("ascii")
+    return header + data + (b"\n" if len(data) % 2 else b"")
+
+
+def tar_gz(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def make_deb(name, version, data):
+    control = ("Package: {name}\nVersion: {version}\nArchitecture: amd64\nMaintainer: Benchmark <bench@localhost>\n"
+               "Installed-Size: {size}\nSection: misc\nPriority: optional\nDescription: benchmark package {name}\n"
+               " synthetic package generated by bench/suite.py\n").format(name=name, version=version,
+                                                                          size=len(data) // 1024)
+    return b"!<arch>\n" + ar_member("debian-binary", b"2.0\n") + \
+        ar_member("control.tar.gz", tar_gz({"./control": control.encode("utf-8")})) + \
+        ar_member("data.tar.gz", tar_gz({"./usr/share/{}/payload".format(name): data}))
+
+
+def make_wheel(dist, version, data):
+    distinfo = "{}-{}.dist-info".format(dist, version)
+    files = {"{}/payload.bin".format(dist): data,
+             distinfo + "/METADATA": "Metadata-Version: 2.1\nName: {}\nVersion: {}\nSummary: benchmark package\n"
+                                     .format(dist, version).encode("utf-8"),
+             distinfo + "/WHEEL": b"Wheel-Version: 1.0\nGenerator: bench\nRoot-Is-Purelib: true\nTag: py3-none-any\n"}
+    record = ""
+    for name, content in files.items():
+        digest = base64.urlsafe_b64encode(hashlib.sha256(content).digest()).rstrip(b"=").decode("ascii")
+        record += "{},sha256={},{}\n".format(name, digest, len(content))
+    files[distinfo + "/RECORD"] = (record + distinfo + "/RECORD,,\n").encode("utf-8")
+
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zf:
+        for name, content in files.items():
+            zf.writestr(name, content)
+    return "{}-{}-py3-none-any.whl".format(dist, version), buf.getvalue()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url, procs, timeout=60):
+    session = requests.Session()
+    session.trust_env = False
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            session.get(url, timeout=5)
+            return
+        except requests.exceptions.ConnectionError:
+            procs.check()
+            time.sleep(0.2)
+    raise Exception(f"{url} did not come up within {timeout}s")
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[int(round(pct / 100 * (len(values) - 1)))] if values else None
+
+
+class Processes(object):
+    def __init__(self, workdir):
+        """
+        Background processes the benchmark needs, with their output kept in `workdir` and shown if they fail
+        """
+        self.workdir = workdir
+        self.procs = []
+
+    def start(self, name, args, env=None):
+        log = open(os.path.join(self.workdir, name + ".log"), "wb")
+        proc = subprocess.Popen(args, stdout=log, stderr=subprocess.STDOUT, cwd=APPROOT,
+                                env=dict(os.environ, **(env or {})))
+        self.procs.append((name, proc, log.name))
+        return proc
+
+    def check(self):
+        for name, proc, logpath in self.procs:
+            if proc.poll() is not None:
+                with open(logpath) as f:
+                    print(f.read()[-4000:], file=sys.stderr)
+                raise Exception(f"{name} exited with {proc.returncode}")
+
+    def stop(self):
+        for _, proc, _ in self.procs:
+            proc.terminate()
+        for _, proc, _ in self.procs:
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+class Client(object):
+    def __init__(self, base):
+        """
+        Runs http requests against the server from a pool of threads, each with its own connection
+        """
+        self.base = base
+        self.local = threading.local()
+
+    def session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+            self.local.session.trust_env = False
+        return self.local.session
+
+    def timed(self, method, path, **kwargs):
+        """
+        Make a request, returning its duration, the number of bytes sent or received and whether it succeeded
+        """
+        start = time.perf_counter()
+        try:
+            resp = self.session().request(method, self.base + path, **kwargs)
+            size = len(kwargs["data"]) if "data" in kwargs else len(resp.content)
+            ok = resp.status_code < 400
+            if not ok:
+                errors = re.findall(r"^\S*(?:Error|Exception)\b.*$", resp.text, re.M) or [resp.text[:200]]
+                sys.stderr.write(f"{method} {path}: {resp.status_code} {errors[-1]}\n")
+        except requests.exceptions.RequestException as e:
+            sys.stderr.write(f"{method} {path}: {e}\n")
+            size, ok = 0, False
+        return time.perf_counter() - start, size, ok
+
+    def run(self, concurrency, jobs):
+        """
+        Run `jobs`, a list of (method, path, kwargs), on `concurrency` threads. Returns a summary of them and whether
+        each succeeded.
+        """
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(lambda job: self.timed(job[0], job[1], **job[2]), jobs))
+        wall = time.perf_counter() - start
+
+        latencies = [r[0] * 1000 for r in results if r[2]]
+        total = sum(r[1] for r in results)
+        return {"requests": len(jobs),
+                "errors": len([r for r in results if not r[2]]),
+                "mb_per_s": round(total / 1024 / 1024 / wall, 3),
+                "req_per_s": round(len(jobs) / wall, 3),
+                "p50_ms": round(percentile(latencies, 50) or 0, 3),
+                "p95_ms": round(percentile(latencies, 95) or 0, 3),
+                "p99_ms": round(percentile(latencies, 99) or 0, 3)}, [r[2] for r in results]
+
+
+class Benchmark(object):
+    def __init__(self, client, args, prefix):
+        self.client = client
+        self.args = args
+        self.prefix = prefix
+        self.results = {}
+        """provider -> repo name -> list of download paths"""
+        self.packages = {"apt": {}, "pypi": {}, "tar": {}}
+
+    def record(self, key, result):
+        self.results[key] = result
+        fields = " ".join("{}={}".format(k, v) for k, v in result.items() if k in MEASURES or k == "errors")
+        print("{:32} {}".format(key, fields))
+
+    def upload_jobs(self, provider, reponame, level):
+        """
+        Generate the uploads of a repo's synthetic packages, returning them and where each can be downloaded from
+        """
+        jobs = []
+        paths = []
+        size = self.args.size * 1024
+        for project in range(self.args.projects):
+            for i in range(self.args.packages):
+                seed = "{}-{}-{}-{}-{}".format(self.args.seed, provider, level, project, i)
+                version = "1.{}.{}".format(project, i)
+                if provider == "apt":
+                    name = "benchpkg{}".format(project)
+                    body = make_deb(name, version, payload(seed, size))
+                    params = {"dist": "bench"}
+                    fname = "{}_{}_amd64.deb".format(name, version)
+                    paths.append("/repo/apt/{}/packages/bench/{}/{}".format(reponame, fname[0], fname))
+                elif provider == "pypi":
+                    name = "benchproj{}".format(project)
+                    fname, body = make_wheel(name, version, payload(seed, size))
+                    params = {"filename": fname}
+                    paths.append("/repo/pypi/{}/{}/{}".format(reponame, name, fname))
+                else:
+                    name = "benchtar{}".format(project)
+                    body = payload(seed, size)
+                    params = {}
+                    fname = "{}-{}.tar.gz".format(name, version)
+                    paths.append("/repo/tar/{}/{}/{}".format(reponame, name, fname))
+
+                params.update(provider=provider, reponame=reponame, name=name, version=version)
+                jobs.append(("POST", "/addpkg", {"params": params, "data": body,
+                                                 "headers": {"Content-Type": "application/octet-stream"}}))
+        return jobs, paths
+
+    def batch_job(self, provider, reponame):
+        """
+        Generate a single batch upload of all of a repo's synthetic packages, as a multipart form
+        """
+        jobs, _ = self.upload_jobs(provider, reponame, "batch")
+        boundary = "benchboundary{}".format(self.args.seed)
+        body = bytearray()
+        for _, _, job in jobs:
+            params = job["params"]
+            for key in ("name", "version"):
+                body += '--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n' \
+                    .format(boundary, key, params[key]).encode("utf-8")
+            body += '--{}\r\nContent-Disposition: form-data; name="f"; filename="{}"\r\n\r\n' \
+                .format(boundary, params.get("filename", "package")).encode("utf-8")
+            body += job["data"] + b"\r\n"
+        body += "--{}--\r\n".format(boundary).encode("utf-8")
+
+        params = {key: value for key, value in jobs[0][2]["params"].items()
+                  if key in ("provider", "reponame", "dist")}
+        return ("POST", "/addpkgs", {"params": params, "data": bytes(body),
+                                     "headers": {"Content-Type": "multipart/form-data; boundary=" + boundary}})
+
+    def wait_regen(self, timeout=600):
+        """
+        Wait until the apt regen queue is empty, returning how long that took
+        """
+        start = time.perf_counter()
+        while time.perf_counter() - start < timeout:
+            status = self.client.session().get(self.client.base + "/status").json()["apt"]
+            if not status["pending"] and not status["running"]:
+                return time.perf_counter() - start
+            time.sleep(0.05)
+        raise Exception("apt regen did not finish within {}s".format(timeout))
+
+    def uploads(self):
+        for level in self.args.concurrency:
+            for provider in ("apt", "pypi", "tar"):
+                reponame = "{}-c{}".format(self.prefix, level)
+                jobs, paths = self.upload_jobs(provider, reponame, level)
+                summary, ok = self.client.run(level, jobs)
+                self.record("upload.{}.c{}".format(provider, level), summary)
+                self.packages[provider][reponame] = [path for path, uploaded in zip(paths, ok) if uploaded]
+        self.wait_regen()
+
+    def batches(self):
+        for provider in ("apt", "pypi", "tar"):
+            job = self.batch_job(provider, "{}-batch".format(self.prefix))
+            start = time.perf_counter()
+            summary, _ = self.client.run(1, [job])
+            if provider == "apt":
+                self.wait_regen()
+            summary["seconds"] = round(time.perf_counter() - start, 3)
+            self.record("batch.{}".format(provider), summary)
+
+    def regen(self):
+        reponame = "{}-c{}".format(self.prefix, self.args.concurrency[0])
+        full, single = [], []
+        for run in range(self.args.regen_runs):
+            self.client.session().get(self.client.base + "/repo/apt/{}".format(reponame), params={"regen": 1})
+            full.append(self.wait_regen())
+
+            self.client.run(1, [("POST", "/addpkg", {
+                "params": {"provider": "apt", "reponame": reponame, "name": "benchextra",
+                           "version": "1.0.{}".format(run), "dist": "bench"},
+                "data": make_deb("benchextra", "1.0.{}".format(run), payload(run, 1024)),
+                "headers": {"Content-Type": "application/octet-stream"}})])
+            single.append(self.wait_regen())
+
+        for name, runs in (("full", full), ("single", single)):
+            self.record("regen.apt.{}".format(name), {"seconds": round(percentile(runs, 50), 3),
+                                                      "runs": [round(r, 3) for r in runs]})
+
+    def indexes(self):
+        reponame = "{}-c{}".format(self.prefix, self.args.concurrency[0])
+        rand = random.Random(self.args.seed)
+        for level in self.args.concurrency:
+            for page in ("repo", "project"):
+                jobs = []
+                for _ in range(self.args.requests):
+                    path = "/repo/pypi/{}/".format(reponame)
+                    if page == "project":
+                        path += "benchproj{}/".format(rand.randrange(self.args.projects))
+                    jobs.append(("GET", path, {}))
+                self.record("index.pypi.{}.c{}".format(page, level), self.client.run(level, jobs)[0])
+
+    def downloads(self):
+        rand = random.Random(self.args.seed)
+        for level in self.args.concurrency:
+            for provider, repos in self.packages.items():
+                paths = repos["{}-c{}".format(self.prefix, self.args.concurrency[0])]
+                if not paths:
+                    continue
+                jobs = [("GET", rand.choice(paths), {}) for _ in range(self.args.requests)]
+                self.record("download.{}.c{}".format(provider, level), self.client.run(level, jobs)[0])
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print how each result compares to the baseline and return the keys of results that are worse by more than
+    `tolerance`, a fraction
+    """
+    regressions = []
+    print("\n{:32} {:10} {:>12} {:>12} {:>8}".format("result", "measure", "baseline", "now", "change"))
+    for key, result in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+        for measure, higher_better in MEASURES.items():
+            if measure not in result or not base.get(measure):
+                continue
+            change = (result[measure] - base[measure]) / base[measure]
+            worse = -change if higher_better else change
+            flag = ""
+            if worse > tolerance:
+                flag = "  WORSE"
+                regressions.append("{} {}".format(key, measure))
+            print("{:32} {:10} {:12.3f} {:12.3f} {:+7.1%}{}".format(key, measure, base[measure], result[measure],
+                                                                    change, flag))
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=APPROOT, stderr=subprocess.DEVNULL) \
+            .decode("ascii").strip()
+    except Exception:
+        return None
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="end to end server benchmark")
+    parser.add_argument('-n', '--packages', default=50, type=int,
+                        help="packages per apt dist, pypi project and tarball name")
+    parser.add_argument('--projects', default=1, type=int,
+                        help="apt package names, pypi projects and tarball names per repo")
+    parser.add_argument('--size', default=256, type=int, help="kilobytes of payload in each package")
+    parser.add_argument('-c', '--concurrency', default="1,4,16",
+                        help="comma separated numbers of concurrent clients to measure at")
+    parser.add_argument('-r', '--requests', default=200, type=int,
+                        help="index and download requests made at each concurrency level")
+    parser.add_argument('--regen-runs', default=3, type=int, help="times apt regen is measured")
+    parser.add_argument('--seed', default=1, type=int, help="seed of the synthetic packages and request order")
+    parser.add_argument('-d', '--database', help="database url, defaults to a fresh sqlite file")
+    parser.add_argument('--s3', help="http:// connection string of an s3 service to use instead of starting one")
+    parser.add_argument('--s3-server', default="moto", choices=["moto", "minio"], help="s3 stand-in to start")
+    parser.add_argument('--minio-binary', default="minio", help="path to the minio server binary")
+    parser.add_argument('--server-arg', action="append", default=[],
+                        help="extra argument for the server, e.g. --server-arg=--download-mode=redirect")
+    parser.add_argument('-o', '--output', help="file to write json results to")
+    parser.add_argument('--baseline', help="json results of an earlier run to compare against")
+    parser.add_argument('--tolerance', default=0.1, type=float,
+                        help="fraction by which a result may be worse than the baseline")
+    args = parser.parse_args()
+    args.concurrency = [int(level) for level in args.concurrency.split(",")]
+
+    workdir = tempfile.mkdtemp(prefix="repobot-bench-")
+    procs = Processes(workdir)
+    try:
+        s3url = args.s3
+        if not s3url:
+            s3port = free_port()
+            if args.s3_server == "moto":
+                procs.start("s3", [sys.executable, "-m", "moto.server", "-H", "127.0.0.1", "-p", str(s3port)])
+            else:
+                procs.start("s3", [args.minio_binary, "server", os.path.join(workdir, "minio"),
+                                   "--address", "127.0.0.1:{}".format(s3port)],
+                            env={"MINIO_ROOT_USER": S3_KEY, "MINIO_ROOT_PASSWORD": S3_SECRET,
+                                 "MINIO_ACCESS_KEY": S3_KEY, "MINIO_SECRET_KEY": S3_SECRET})
+            wait_for("http://127.0.0.1:{}/".format(s3port), procs)
+            s3url = "http://{}:{}@127.0.0.1:{}/{}".format(S3_KEY, S3_SECRET, s3port, BUCKET)
+
+        database = args.database or "sqlite:///{}".format(os.path.join(workdir, "bench.db"))
+        port = free_port()
+        procs.start("server", [sys.executable, "-m", "repobot.server", "-p", str(port), "-d", database, "-s", s3url,
+                               "--regen-delay", "0"] + args.server_arg)
+        base = "http://127.0.0.1:{}".format(port)
+        wait_for(base + "/", procs)
+
+        bench = Benchmark(Client(base), args, "bench{}".format(int(time.time())))
+        bench.uploads()
+        bench.batches()
+        bench.regen()
+        bench.indexes()
+        bench.downloads()
+        procs.check()
+    finally:
+        procs.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = {"meta": {"commit": git_commit(),
+                       "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                       "python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "cpus": os.cpu_count(),
+                       "database": database.split(":", 1)[0] if args.database else "sqlite",
+                       "s3": "external" if args.s3 else args.s3_server,
+                       "args": {k: v for k, v in vars(args).items() if k not in ("database", "s3", "output",
+                                                                                 "baseline", "tolerance")}},
+              "results": bench.results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["meta"]["args"] != output["meta"]["args"]:
+            print("warning: the baseline was run with different arguments", file=sys.stderr)
+        regressions = compare(bench.results, baseline["results"], args.tolerance)
+        if regressions:
+            print("\n{} results are worse than the baseline".format(len(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
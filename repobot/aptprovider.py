@@ -1,29 +1,39 @@
 import cherrypy
-import gnupg
+import gzip
 import hashlib
 import json
+import lzma
 import os
-import queue
 import sqlalchemy
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from pydpkg import Dpkg
-from sqlalchemy import Column, ForeignKey, UniqueConstraint
-from sqlalchemy.dialects.mysql import LONGTEXT
-from sqlalchemy.orm import relationship
-from sqlalchemy.types import String, Integer, Text, BOOLEAN
-from tempfile import TemporaryDirectory
-from threading import Thread
-from repobot.tables import Base, db
+from io import BytesIO
+from itertools import groupby
+from sqlalchemy import Column, ForeignKey, UniqueConstraint, distinct, exists, func, or_
+from sqlalchemy.dialects.mysql import LONGBLOB, LONGTEXT
+from sqlalchemy.orm import deferred, relationship, undefer
+from sqlalchemy.types import String, Integer, Text, BOOLEAN, LargeBinary
+from threading import Lock, Thread
+from repobot.blobs import BlobStore
+from repobot.cache import LRUCache
+from repobot.debstream import DebControlReader
+from repobot.ingest import READ_CHUNK, MultiHasher, committing, hashmany
+from repobot.metrics import SIGN_SECONDS, set_route
+from repobot.regen import RegenQueue
+from repobot.signing import SigningService
+from repobot.tracing import span
+from repobot.tables import Base, added_columns, db, get_or_create
 
 
 class AptRepo(Base):
     __tablename__ = 'aptrepo'
     id = Column(Integer, primary_key=True)
     name = Column(String(length=32), unique=True, nullable=False)
-    gpgkey = Column(Text(), nullable=True)
-    gpgkeyprint = Column(Text(), nullable=True)
-    gpgpubkey = Column(Text(), nullable=True)
+    gpgkey = deferred(Column(Text(), nullable=True), group="gpg")
+    gpgkeyprint = deferred(Column(Text(), nullable=True), group="gpg")
+    gpgpubkey = deferred(Column(Text(), nullable=True), group="gpg")
 
     dists = relationship("AptDist")
 
@@ -35,16 +45,63 @@ class AptDist(Base):
     repo = relationship("AptRepo")
 
     dirty = Column(BOOLEAN(), nullable=False, default=False)
+    # bumped every time the dist's metadata is regenerated
+    generation = Column(Integer, nullable=False, default=0, server_default="0")
 
     name = Column(String(length=32), nullable=False)
 
-    packages_cache = Column(LONGTEXT(), nullable=True)
-    release_cache = Column(Text(), nullable=True)
-    sig_cache = Column(Text(), nullable=True)
+    release_cache = deferred(Column(Text(), nullable=True), group="release")
+    sig_cache = deferred(Column(Text(), nullable=True), group="release")
+    inrelease_cache = deferred(Column(Text(), nullable=True), group="release")
 
     __table_args__ = (UniqueConstraint('repo_id', 'name', name='apt_unique_repodist'), )
 
 
+class AptIndex(Base):
+    """
+    The Packages index of one component and architecture of a dist
+    """
+    __tablename__ = 'aptindex'
+    id = Column(Integer, primary_key=True)
+    dist_id = Column(Integer, ForeignKey("aptdist.id"), nullable=False)
+    dist = relationship("AptDist")
+
+    component = Column(String(length=64), nullable=False)  # 'main'
+    arch = Column(String(length=16), nullable=False)  # 'amd64'
+
+    packages = deferred(Column(Text().with_variant(LONGTEXT(), "mysql"), nullable=True))
+    lastid = Column(Integer, nullable=True)  # highest AptPackage.id included in packages
+    count = Column(Integer, nullable=True)  # number of stanzas in packages
+
+    __table_args__ = (UniqueConstraint('dist_id', 'component', 'arch', name='apt_unique_distindex'), )
+
+    @property
+    def directory(self):
+        return index_directory(self.component, self.arch)
+
+
+class AptIndexFile(Base):
+    """
+    A generated index file of a dist, such as main/binary-amd64/Packages.xz. Superseded versions are kept for a while
+    so that clients holding an older Release can still fetch them by-hash.
+    """
+    __tablename__ = 'aptindexfile'
+    id = Column(Integer, primary_key=True)
+    dist_id = Column(Integer, ForeignKey("aptdist.id"), nullable=False)
+
+    path = Column(String(length=256), nullable=False)  # 'main/binary-amd64/Packages.gz', relative to dists/<dist>/
+    current = Column(BOOLEAN(), nullable=False, default=True)
+    published = Column(BOOLEAN(), nullable=False, default=False)  # written to s3 by the provider's publisher
+
+    size = Column(Integer, nullable=False)
+    md5 = Column(String(length=32), index=True)
+    sha1 = Column(String(length=40), index=True)
+    sha256 = Column(String(length=64), index=True)
+    sha512 = Column(String(length=128), index=True)
+
+    data = deferred(Column(LargeBinary().with_variant(LONGBLOB(), "mysql"), nullable=False))
+
+
 class AptPackage(Base):
     __tablename__ = 'aptpkg'
     id = Column(Integer, primary_key=True)
@@ -55,11 +112,11 @@ class AptPackage(Base):
     dist_id = Column(Integer, ForeignKey("aptdist.id"), nullable=False)
     dist = relationship("AptDist")
 
-    # index       (always 'binary-amd64' for now)
+    component = Column(String(length=64), nullable=False, default="main", server_default="main")  # 'main'
 
     name = Column(String(length=128), nullable=False)  # 'python3-pip'
     version = Column(String(length=128), nullable=False)  # '4.20.1'
-    arch = Column(String(length=16), nullable=False)  # 'amd64'
+    arch = Column(String(length=16), nullable=False)  # 'amd64', or 'all' to be listed in every architecture's index
 
     fname = Column(String(length=256), nullable=False)
 
@@ -70,37 +127,43 @@ class AptPackage(Base):
     sha256 = Column(String(length=64))
     sha512 = Column(String(length=128))
 
-    fields = Column(Text())
+    fields = deferred(Column(Text()))
+    stanza = deferred(Column(Text(), nullable=True))  # pre-rendered entry for the Packages index
 
     __table_args__ = (UniqueConstraint('name', 'version', 'arch', 'repo_id', 'dist_id', name='apt_unique_repodist'), )
 
     @property
     def blobpath(self):
-        return os.path.join("repos", self.repo.name, "packages", self.dist.name, self.name[0], self.fname)
+        return package_blobpath(self.repo.name, self.dist.name, self.fname)
+
+
+added_columns(AptDist, "inrelease_cache", "generation")
+added_columns(AptPackage, "stanza", "component")
+
+
+def package_blobpath(reponame, distname, fname):
+    """
+    Return the path of a package file within the provider's s3 base path, repos/<reponame>/packages/<dist>/f/foo.deb
+    """
+    return os.path.join("repos", reponame, "packages", distname, fname[0], fname)
+
+
+def index_directory(component, arch):
+    return "{}/binary-{}".format(component, arch)
 
 
 def get_repo(_db, repo_name, create_ok=True):
     """
     Fetch a repo from the database by name
     """
-    repo = _db.query(AptRepo).filter(AptRepo.name == repo_name).first()
-    if not repo and create_ok:
-        repo = AptRepo(name=repo_name)
-        _db.add(repo)
-        _db.commit()
-    return repo
+    return get_or_create(_db, AptRepo, create_ok, name=repo_name)
 
 
 def get_dist(_db, repo, dist_name, create_ok=True):
     """
     Fetch a repo's dist from the database by name
     """
-    dist = _db.query(AptDist).filter(AptDist.name == dist_name, AptDist.repo_id == repo.id).first()
-    if not dist and create_ok:
-        dist = AptDist(name=dist_name, repo_id=repo.id)
-        _db.add(dist)
-        _db.commit()
-    return dist
+    return get_or_create(_db, AptDist, create_ok, name=dist_name, repo_id=repo.id)
 
 
 algos = {"md5": "MD5Sum",
@@ -108,217 +171,522 @@ algos = {"md5": "MD5Sum",
          "sha256": "SHA256",
          "sha512": "SHA512"}
 
+"""architectures every dist publishes indexes for, along with those of the packages in it, so that clients of them keep
+finding architecture independent packages however the dist's other packages come and go"""
+DEFAULT_ARCHS = ["amd64"]
 
-def copyhash(fin, fout):
-    """
-    Copy a file and calculate hashes while doing so
-    """
-    hashes = {}
-    for algo in algos.keys():
-        hashes[algo] = getattr(hashlib, algo)()
+"""number of versions of each index file to keep available by-hash"""
+INDEX_HISTORY = 3
+
+"""the control file must be found within this many bytes of the start of a deb"""
+MAX_CONTROL_READ = 16 * 1024 * 1024
 
-    while True:
-        data = fin.read(4096)
-        if not data:
-            break
-        for h in hashes.values():
-            h.update(data)
-        fout.write(data)
 
-    return {k: v.hexdigest() for k, v in hashes.items()}
+def gzip_compress(data):
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb", mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
 
 
-def hashmany(data):
+"""index files are published uncompressed and with each of these compressions, by file suffix"""
+compressors = {"": lambda data: data,
+               ".gz": gzip_compress,
+               ".xz": lzma.compress}
+
+content_types = {"": "text/plain",
+                 ".gz": "application/gzip",
+                 ".xz": "application/x-xz"}
+
+
+def render_stanza(fields, hashes, filename, size):
     """
-    Hash the input data using several algos
+    Render a package's entry in the Packages index
     """
-    hashes = {}
-    for algo in algos.keys():
-        hashes[algo] = getattr(hashlib, algo)()
+    lines = ["{}: {}".format(k, v) for k, v in fields.items()]
+    lines += ["{}: {}".format(algoname, hashes[algo]) for algo, algoname in algos.items()]
+    lines.append("Filename: {}".format(filename))
+    lines.append("Size: {}".format(size))
+    return "\n".join(lines) + "\n\n"
 
-    for h in hashes.values():
-        h.update(data)
 
-    return {k: v.hexdigest() for k, v in hashes.items()}
+def package_stanza(dist, package):
+    """
+    Render the Packages entry for an AptPackage row
+    """
+    return render_stanza(json.loads(package.fields),
+                         {algo: getattr(package, algo) for algo in algos.keys()},
+                         "packages/{}/{}/{}".format(dist.name, package.fname[0], package.fname),
+                         package.size)
+
+
+def by_hash_key(prefix, index_file, algo, algoname):
+    """
+    Return the s3 key an AptIndexFile is published at by-hash, such as <prefix>/main/binary-amd64/by-hash/SHA256/<hash>
+    """
+    return os.path.join(prefix, os.path.dirname(index_file.path), "by-hash", algoname, getattr(index_file, algo))
 
 
 class AptProvider(object):
-    def __init__(self, dbcon, s3client, bucket):
+    def __init__(self, dbcon, s3client, bucket, regen_workers=4, regen_delay=2.0, spare_keys=1,
+                 cache_size=64 * 1024 * 1024, blobs=None, publisher=None, archs=DEFAULT_ARCHS):
         self.db = dbcon
         self.s3 = s3client
         self.bucket = bucket
         """base path within the s3 bucket"""
         self.basepath = "data/provider/apt"
-        """queue entries are tuples containing the database id of the dist to regenerate indexes and signatures for"""
-        self.queue = queue.Queue()
+        """answers package downloads"""
+        self.blobs = blobs or BlobStore(s3client, bucket)
+        """builds the (component, arch) indexes of dists being regenerated"""
+        self.index_pool = ThreadPoolExecutor(max_workers=regen_workers)
+        """keeps repo signing keys unlocked in memory and pregenerates keys for new repos"""
+        self.signing = SigningService(spare_keys=spare_keys)
+        """held while assigning a repo's signing key, so that dists of the same repo don't each get one"""
+        self.keylock = Lock()
+        """(repo name, dist name, *path) -> (content type, body) of the metadata files served under dists/"""
+        self.cache = LRUCache(cache_size)
+        """writes dist metadata to s3 for static serving, if set"""
+        self.publisher = publisher
+        """architectures published by every dist"""
+        self.archs = list(archs)
+
+        self.Session = sqlalchemy.orm.sessionmaker(autoflush=True, autocommit=False)
+        self.Session.configure(bind=self.db)
+
+        """collapses and debounces regen requests per dist id, regenerating different dists in parallel. The queue is
+        kept in the database and shared with any other nodes using it."""
+        self.scheduler = RegenQueue("apt", self.sign_packages, self.Session, workers=regen_workers, delay=regen_delay)
+        """dist id -> generation of the dist's metadata held in self.cache"""
+        self.generations = {}
+
+        # after SAEnginePlugin has created the tables
+        cherrypy.engine.subscribe("start", self.start, priority=80)
 
         cherrypy.tree.mount(AptWeb(self), "/repo/apt", {'/': {'tools.trailing_slash.on': False,
                                                               'tools.db.on': True}})
 
-        self.updater = Thread(target=self.sign_packages, daemon=True)
-        self.updater.start()
-
-    def sign_packages(self):
-        Session = sqlalchemy.orm.sessionmaker(autoflush=True, autocommit=False)
-        Session.configure(bind=self.db)
+    def start(self):
+        """
+        Start regenerating dists, first queueing any that were left dirty by a previous run, and any without index files,
+        such as dists created before index files were stored, whose Packages files would otherwise not be found
+        """
+        session = self.Session()
+        try:
+            indexed = exists().where(AptIndexFile.dist_id == AptDist.id).where(AptIndexFile.current == True)
+            dirty = [row.id for row in session.query(AptDist.id).filter(or_(AptDist.dirty == True, ~indexed)).all()]
+        finally:
+            session.close()
+        for dist_id in dirty:
+            self.regen_dist(dist_id)
+        self.scheduler.start()
+        Thread(target=self._watch_generations, daemon=True).start()
+
+    def _watch_generations(self):
+        """
+        Drop cached metadata of dists that were regenerated by other nodes
+        """
         while True:
+            session = self.Session()
             try:
-                work = self.queue.get(block=True, timeout=5)
-            except queue.Empty:
-                continue
-
-            session = Session()
-            try:
-                self._sign_packages(session, work)
-            except:
+                for dist in session.query(AptDist.id, AptDist.generation, AptDist.name, AptRepo.name.label("repo")) \
+                        .join(AptRepo, AptDist.repo_id == AptRepo.id).all():
+                    seen = self.generations.get(dist.id, dist.generation)
+                    self.generations[dist.id] = dist.generation
+                    if seen != dist.generation:
+                        self.cache.invalidate(dist.repo, dist.name)
+            except Exception:
                 traceback.print_exc()
             finally:
                 session.close()
-
-    def _sign_packages(self, session, work):
-        dist_id = work[0]
+            time.sleep(self.scheduler.poll)
+
+    def sign_packages(self, dist_id, indexes=None):
+        session = self.Session()
+        try:
+            self._sign_packages(session, dist_id, indexes)
+        finally:
+            session.close()
+
+    def _sign_packages(self, session, dist_id, indexes=None):
+        """
+        Regenerate a dist's indexes and sign its Release. `indexes` is a set of (component, arch) tuples whose packages
+        changed, in which case only the indexes containing those packages are rebuilt; if None, every index of the dist
+        is checked for changes.
+        """
         dist = session.query(AptDist).filter(AptDist.id == dist_id).first()
         print("Generating metadata for repo:{} dist:{}".format(dist.repo.name, dist.name))
 
-        str_packages = ""
-
-        for package in session.query(AptPackage) \
-                .filter(AptPackage.repo == dist.repo,
-                        AptPackage.dist == dist) \
-                .order_by(AptPackage.id).all():
-            fields = json.loads(package.fields)
-            for k, v in fields.items():
-                str_packages += "{}: {}\n".format(k, v)
-            for algo, algoname in algos.items():
-                str_packages += "{}: {}\n".format(algoname, getattr(package, algo))
-
-            str_packages += "Filename: packages/{}/{}/{}\n".format(dist.name, package.fname[0], package.fname)
-            str_packages += "Size: {}\n".format(package.size)
-
-            str_packages += "\n"
-
-        dist.packages_cache = str_packages.encode("utf-8")
-
-        release_hashes = hashmany(dist.packages_cache)
+        if not dist.repo.gpgkey:
+            self._generate_key(session, dist.repo)
+
+        # packages uploaded before stanzas were stored
+        for package in session.query(AptPackage).options(undefer(AptPackage.fields)) \
+                .filter(AptPackage.dist_id == dist.id,
+                        AptPackage.stanza == None).all():
+            package.stanza = package_stanza(dist, package)
+
+        components = sorted([row[0] for row in session.query(distinct(AptPackage.component))
+                             .filter(AptPackage.dist_id == dist.id).all()]) or ["main"]
+        archs = sorted(set(self.archs) | {row[0] for row in session.query(distinct(AptPackage.arch))
+                                          .filter(AptPackage.dist_id == dist.id,
+                                                  AptPackage.arch != "all").all()})
+
+        # every component gets an index for every arch; indexes whose component is gone, or whose arch is neither
+        # configured nor present, are retired
+        existing = {(index.component, index.arch): index
+                    for index in session.query(AptIndex).filter(AptIndex.dist_id == dist.id).all()}
+        for (component, arch), index in existing.items():
+            if component not in components or arch not in archs:
+                session.query(AptIndexFile).filter(AptIndexFile.dist_id == dist.id,
+                                                   AptIndexFile.path.startswith(index.directory + "/")) \
+                    .update({AptIndexFile.current: False}, synchronize_session=False)
+                session.delete(index)
+
+        build = []
+        for component in components:
+            for arch in archs:
+                index = existing.get((component, arch))
+                if not index:
+                    index = AptIndex(dist_id=dist.id, component=component, arch=arch)
+                    session.add(index)
+                elif indexes is not None and not indexes & {(component, arch), (component, "all")}:
+                    continue
+                build.append(index)
+        session.commit()
+
+        # indexes are independent of each other and built in parallel
+        with span("index"):
+            list(self.index_pool.map(self.build_index, [index.id for index in build]))
 
         str_release = """Origin: . {dist}
 Label: . {dist}
 Suite: {dist}
 Codename: {dist}
 Date: {time}
-Architectures: amd64
-Components: main
+Architectures: {archs}
+Components: {components}
 Description: Generated by Repobot
-""".format(dist=dist.name, time=datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S UTC"))
+Acquire-By-Hash: yes
+""".format(dist=dist.name, time=datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S UTC"),
+           archs=" ".join(archs), components=" ".join(components))
+
+        index_files = session.query(AptIndexFile.path, AptIndexFile.size,
+                                    *[getattr(AptIndexFile, algo) for algo in algos.keys()]) \
+            .filter(AptIndexFile.dist_id == dist.id,
+                    AptIndexFile.current == True) \
+            .order_by(AptIndexFile.path).all()
         for algo, algoname in algos.items():
-            str_release += "{}:\n {} {} {}/{}/{}\n".format(algoname,
-                                                           release_hashes[algo],
-                                                           len(dist.packages_cache),
-                                                           "main",  #TODO component
-                                                           "binary-amd64",  #TODO whatever this was
-                                                           "Packages")
+            str_release += "{}:\n".format(algoname)
+            for index_file in index_files:
+                str_release += " {} {} {}\n".format(getattr(index_file, algo), index_file.size, index_file.path)
 
         dist.release_cache = str_release.encode("utf-8")
 
-        keyemail = 'debian_signing@localhost'
-
-        with TemporaryDirectory() as tdir:
-            gpg = gnupg.GPG(gnupghome=tdir)
-
-            def getkey():
-                keys = [i for i in gpg.list_keys(secret=True) if any([keyemail in k for k in i["uids"]])]
-                if keys:
-                    return keys[0]
-
-            fingerprint = None
-
-            if not dist.repo.gpgkey:
-                print("Generating key for", dist.repo.name)
-                key = gpg.gen_key(gpg.gen_key_input(name_email=keyemail,
-                                                    expire_date='2029-04-28',
-                                                    key_type='RSA',
-                                                    key_length=4096,
-                                                    key_usage='encrypt,sign,auth',
-                                                    passphrase="secret"))
-                fingerprint = key.fingerprint
-                dist.repo.gpgkey = gpg.export_keys(fingerprint, secret=True, passphrase="secret")
-                dist.repo.gpgkeyprint = fingerprint
-                dist.repo.gpgpubkey = gpg.export_keys(fingerprint)
-
-            else:
-                import_result = gpg.import_keys(dist.repo.gpgkey)
-                fingerprint = import_result.results[0]['fingerprint']  # errors here suggests some gpg import issue
-                assert(fingerprint == getkey()['fingerprint'])
-
-            dist.sig_cache = gpg.sign(dist.release_cache, keyid=fingerprint, passphrase='secret',
-                                      detach=True, clearsign=False).data
-            dist.dirty = False
-            session.commit()
+        with SIGN_SECONDS.time(), span("sign"):
+            dist.sig_cache = self.signing.sign(dist.repo.gpgkey, dist.repo.gpgkeyprint, dist.release_cache)
+            dist.inrelease_cache = self.signing.clearsign(dist.repo.gpgkey, dist.repo.gpgkeyprint,
+                                                           str_release.rstrip("\n"))
+        dist.dirty = False
+        dist.generation += 1
+        session.commit()
+        self.generations[dist.id] = dist.generation
+        self.cache.invalidate(dist.repo.name, dist.name)
+
+        if self.publisher:
+            with span("publish"):
+                self._publish_dist(session, dist)
         print("Metadata generation complete")
 
-    def web_addpkg(self, reponame, name, version, fobj, dist):
+    def _publish_dist(self, session, dist):
+        """
+        Write a dist's metadata to s3 under repos/<reponame>/dists/<dist>/, next to the repo's packages/. Index files
+        are written by-hash first and Release files last, so a client reading the new Release always finds the indexes
+        it lists.
+        """
+        prefix = os.path.join(self.basepath, "repos", dist.repo.name, "dists", dist.name)
+
+        index_files = session.query(AptIndexFile).options(undefer(AptIndexFile.data)) \
+            .filter(AptIndexFile.dist_id == dist.id,
+                    AptIndexFile.current == True,
+                    AptIndexFile.published == False).all()
+        for index_file in index_files:
+            content_type = content_types[os.path.splitext(index_file.path)[1]]
+            for algo, algoname in algos.items():
+                self.publisher.put(by_hash_key(prefix, index_file, algo, algoname), index_file.data, content_type,
+                                   immutable=True)
+        for index_file in index_files:
+            self.publisher.put(os.path.join(prefix, index_file.path), index_file.data,
+                               content_types[os.path.splitext(index_file.path)[1]])
+            index_file.published = True
+        session.commit()
+
+        self.publisher.put(os.path.join(self.basepath, "repos", dist.repo.name, "pubkey"), dist.repo.gpgpubkey,
+                           "text/plain")
+        self.publisher.put(os.path.join(prefix, "Release"), dist.release_cache, "text/plain")
+        self.publisher.put(os.path.join(prefix, "Release.gpg"), dist.sig_cache, "text/plain")
+        self.publisher.put(os.path.join(prefix, "InRelease"), dist.inrelease_cache, "text/plain")
+
+    def _generate_key(self, session, repo):
+        """
+        Assign the repo a signing key, unless another dist of the same repo did so first, on this node or another
+        """
+        with self.keylock:
+            session.refresh(repo)
+            if repo.gpgkey:
+                return
+
+            print("Assigning key for", repo.name)
+            gpgkey, gpgkeyprint, gpgpubkey = self.signing.new_key()
+            session.query(AptRepo).filter(AptRepo.id == repo.id, AptRepo.gpgkey == None) \
+                .update({AptRepo.gpgkey: gpgkey,
+                         AptRepo.gpgkeyprint: gpgkeyprint,
+                         AptRepo.gpgpubkey: gpgpubkey}, synchronize_session=False)
+            session.commit()
+            session.refresh(repo)
+
+    def build_index(self, index_id):
+        session = self.Session()
+        try:
+            index = session.query(AptIndex).filter(AptIndex.id == index_id).first()
+            self._build_packages(session, index)
+            self._store_index(session, index.dist_id, index.directory + "/Packages", index.packages.encode("utf-8"))
+            session.commit()
+        finally:
+            session.close()
+
+    def _store_index(self, session, dist_id, path, data):
+        """
+        Store an index and its compressed variants as the dist's current version of them, if it has changed
+        """
+        current = session.query(AptIndexFile.sha256).filter(AptIndexFile.dist_id == dist_id,
+                                                             AptIndexFile.path == path,
+                                                             AptIndexFile.current == True).first()
+        if current and current.sha256 == hashlib.sha256(data).hexdigest():
+            return
+
+        for suffix, compress in compressors.items():
+            content = compress(data)
+            session.query(AptIndexFile).filter(AptIndexFile.dist_id == dist_id,
+                                               AptIndexFile.path == path + suffix) \
+                .update({AptIndexFile.current: False}, synchronize_session=False)
+            session.add(AptIndexFile(dist_id=dist_id, path=path + suffix, current=True, size=len(content),
+                                     data=content, **hashmany(content, algos.keys())))
+
+            expired = session.query(AptIndexFile).filter(AptIndexFile.dist_id == dist_id,
+                                                         AptIndexFile.path == path + suffix) \
+                .order_by(AptIndexFile.id.desc()).offset(INDEX_HISTORY).all()
+            if expired:
+                self._unpublish(session, dist_id, [row for row in expired if row.published])
+                session.query(AptIndexFile).filter(AptIndexFile.id.in_([row.id for row in expired])) \
+                    .delete(synchronize_session=False)
+
+    def _unpublish(self, session, dist_id, index_files):
+        """
+        Remove the by-hash copies of expired index files from s3
+        """
+        if not index_files or not self.publisher:
+            return
+        dist = session.query(AptDist).filter(AptDist.id == dist_id).first()
+        prefix = os.path.join(self.basepath, "repos", dist.repo.name, "dists", dist.name)
+        for index_file in index_files:
+            for algo, algoname in algos.items():
+                self.publisher.delete(by_hash_key(prefix, index_file, algo, algoname))
+
+    def _build_packages(self, session, index):
+        """
+        Bring a Packages index up to date. Stanzas are rendered once, at upload time; newly added packages are appended
+        to the existing index and the index is only reassembled from the stored stanzas when packages have been
+        removed.
+        """
+        query = session.query(AptPackage.id, AptPackage.stanza) \
+            .filter(AptPackage.dist_id == index.dist_id,
+                    AptPackage.component == index.component,
+                    AptPackage.arch.in_([index.arch, "all"]))
+
+        count = query.with_entities(func.count(AptPackage.id)).scalar()
+
+        if index.packages is not None and index.lastid is not None:
+            new = query.filter(AptPackage.id > index.lastid).order_by(AptPackage.id).all()
+            if index.count + len(new) == count:
+                if new:
+                    index.packages += "".join([row.stanza for row in new])
+                    index.lastid = new[-1].id
+                    index.count = count
+                return
+
+        rows = query.order_by(AptPackage.id).all()
+        index.packages = "".join([row.stanza for row in rows])
+        index.lastid = rows[-1].id if rows else 0
+        index.count = len(rows)
+
+    def _ingest(self, repo, dist, fobj, component="main", pending=()):
+        """
+        Stream a package to s3, returning its row, not yet added to the session, its s3 path and its control fields.
+        `pending` holds the (name, version, arch) of packages of the same dist that are about to be added alongside it.
+        """
+        # a single pass over the upload hashes it, finds the control file and streams it to s3. Data read before the
+        # control file is found is held until we know the package's name and can start the upload.
+        hasher = MultiHasher(algos.keys())
+        reader = DebControlReader(max_control_size=MAX_CONTROL_READ)
+        head = bytearray()
+        upload = None
+        try:
+            while True:
+                with span("read"):
+                    data = fobj.file.read(READ_CHUNK)
+                if not data:
+                    break
+                hasher.update(data)
+
+                if upload is not None:
+                    with span("write"):
+                        upload.write(data)
+                    continue
+
+                with span("parse"):
+                    reader.feed(data)
+                head += data
+                if reader.control is None:
+                    assert(len(head) <= MAX_CONTROL_READ), "control file not found at the start of the package"
+                    continue
+
+                message = reader.control
+                pkgname = "{}_{}_{}.deb".format(message['Package'], message['Version'], message['Architecture'])
+                assert((message['Package'], message['Version'], message['Architecture']) not in pending and
+                       not db().query(AptPackage).filter(AptPackage.repo == repo,
+                                                         AptPackage.dist == dist,
+                                                         AptPackage.name == message['Package'],
+                                                         AptPackage.version == message['Version'],
+                                                         AptPackage.arch == message['Architecture']).first()), \
+                    f"{pkgname} already exists in {dist.name}"
+
+                dpath = os.path.join(self.basepath, package_blobpath(repo.name, dist.name, pkgname))
+                files = self.s3.list_objects(Bucket=self.bucket, Prefix=dpath).get("Contents")
+                if files:
+                    print(f"will overwrite: {files}")
+
+                upload = self.blobs.upload(dpath)
+                with span("write"):
+                    upload.write(head)
+                head = None
+
+            assert(upload is not None), "not a deb package, or it is truncated"
+            with span("write"):
+                upload.close()
+        except Exception:
+            if upload is not None:
+                upload.abort()
+            raise
+
+        fhashes = hasher.hexdigests()
+        fsize = hasher.size
+
+        #TODO keys can be duplicated in email.message.Message, does this cause any problems?
+        fields = {key: message[key] for key in message.keys()}
+
+        pkg = AptPackage(repo=repo, dist=dist,
+                         component=component,
+                         name=message['Package'],
+                         version=message['Version'],
+                         arch=message['Architecture'],
+                         fname=pkgname,
+                         size=fsize,
+                         **fhashes,
+                         fields=json.dumps(fields),
+                         stanza=render_stanza(fields, fhashes,
+                                              "packages/{}/{}/{}".format(dist.name, pkgname[0], pkgname), fsize))
+        return pkg, dpath, message
+
+    def web_addpkg(self, reponame, name, version, fobj, dist, component="main"):
         repo = get_repo(db(), reponame)
         dist = get_dist(db(), repo, dist)
         print("Dist:", dist)
 
-        # - read f (write to temp storage if needed) and generate the hashes
-        # - load with Dpkg to get name version and whatnot
-        with TemporaryDirectory() as tdir:
-            tmppkgpath = os.path.join(tdir, "temp.deb")
-            with open(tmppkgpath, "wb") as fdest:
-                fhashes = copyhash(fobj.file, fdest)
-            fsize = os.path.getsize(tmppkgpath)
-
-            p = Dpkg(tmppkgpath)
-            pkgname = "{}_{}_{}.deb".format(p.message['Package'], p.message['Version'], p.message['Architecture'])
-
-            #TODO keys can be duplicated in email.message.Message, does this cause any problems?
-            fields = {key: p.message[key] for key in p.message.keys()}
-
-            # repos/<reponame>/packages/f/foo.deb
-            dpath = os.path.join(self.basepath, "repos", repo.name, "packages", dist.name, pkgname[0], pkgname)
-            files = self.s3.list_objects(Bucket=self.bucket, Prefix=dpath).get("Contents")
-            if files:
-                print(f"will overwrite: {files}")
-
-            pkg = AptPackage(repo=repo, dist=dist,
-                             name=p.message['Package'],
-                             version=p.message['Version'],
-                             arch=p.message['Architecture'],
-                             fname=pkgname,
-                             size=fsize,
-                             **fhashes,
-                             fields=json.dumps(fields))
+        pkg, dpath, message = self._ingest(repo, dist, fobj, component)
+        with committing(db(), self.s3, self.bucket, [dpath]):
             db().add(pkg)
-            db().commit()
-
-            try:
-                with open(tmppkgpath, "rb") as f:
-                    response = self.s3.put_object(Body=f, Bucket=self.bucket, Key=dpath)
-                    assert(response["ResponseMetadata"]["HTTPStatusCode"] == 200), f"Upload failed: {response}"
-            except Exception:
-                db().delete(pkg)
-                db().commit()
-                raise
+            dist.dirty = True
 
-        dist.dirty = True
-        db().commit()
-        self.regen_dist(dist.id)
+        self.regen_dist(dist.id, (pkg.component, pkg.arch))
 
-        yield "package name: {}\n".format(pkgname)
-        yield "package size: {}\n".format(fsize)
-        yield "package message:\n-----------------\n{}\n-----------------\n".format(p.message)
-        yield "package hashes: {}\n".format(fhashes)
+        yield "package name: {}\n".format(pkg.fname)
+        yield "package size: {}\n".format(pkg.size)
+        yield "package message:\n-----------------\n{}\n-----------------\n".format(message)
+        yield "package hashes: {}\n".format({algo: getattr(pkg, algo) for algo in algos.keys()})
 
-    def regen_dist(self, dist_id):
-        self.queue.put((dist_id, ))
+    def web_addpkgs(self, reponame, uploads):
+        """
+        Add many packages to a repo, committing them together once all have been stored and regenerating each dist
+        they were added to once. `uploads` yields (file, params) for each package, where params are those of
+        web_addpkg. If any package fails, none are added.
+        """
+        repo = get_repo(db(), reponame)
+        dists = {}
+        """dist name -> (name, version, arch) of the packages added to it"""
+        pending = {}
+        """dist id -> (component, arch) of the packages added to it"""
+        changed = {}
+        pkgs = []
+        dpaths = []
+        output = []
+        with committing(db(), self.s3, self.bucket, dpaths):
+            for fobj, params in uploads:
+                name = params.get("dist")
+                assert(name), f"no dist given for {fobj.filename}"
+                if name not in dists:
+                    dists[name] = get_dist(db(), repo, name)
+                    pending[name] = set()
+                dist = dists[name]
+
+                pkg, dpath, _ = self._ingest(repo, dist, fobj, params.get("component", "main"), pending=pending[name])
+                pkgs.append(pkg)
+                dpaths.append(dpath)
+                pending[name].add((pkg.name, pkg.version, pkg.arch))
+                changed.setdefault(dist.id, set()).add((pkg.component, pkg.arch))
+                output += ["package name: {}\n".format(pkg.fname),
+                           "package size: {}\n".format(pkg.size),
+                           "package hashes: {}\n".format({algo: getattr(pkg, algo) for algo in algos.keys()})]
+
+            db().add_all(pkgs)
+            for dist in dists.values():
+                dist.dirty = True
+
+        for dist_id, indexes in changed.items():
+            self.regen_dist(dist_id, *indexes)
+
+        yield from output
+
+    def regen_dist(self, dist_id, *indexes):
+        """
+        Schedule regeneration of a dist's metadata. `indexes` are the (component, arch) of changed packages, if only
+        the indexes listing those packages need to be rebuilt.
+        """
+        self.scheduler.submit(dist_id, *indexes)
 
         #TODO
         # - verify dpkg name & version match params
         # - copy to persistent storage
-        # - add db record keyed under repo name and dist (and index but only 'binary-amd64' for now)
+        # - add db record keyed under repo name, dist and index
         # - mark dist dirty
 
+    def status(self):
+        """
+        Report the regen scheduler's queue depth and how far behind each dist's metadata is, in seconds
+        """
+        stats = self.scheduler.stats()
+        lag = stats.pop("lag")
+        dists = {}
+        if lag:
+            session = self.Session()
+            try:
+                for dist in session.query(AptDist).filter(AptDist.id.in_(list(lag.keys()))).all():
+                    dists["{}/{}".format(dist.repo.name, dist.name)] = round(lag[dist.id], 3)
+            finally:
+                session.close()
+        stats["lag"] = dists
+        stats["metadata_cache"] = self.cache.stats()
+        return stats
+
 
 @cherrypy.popargs("reponame")
 class AptWeb(object):
@@ -329,26 +697,55 @@ class AptWeb(object):
 
     @cherrypy.expose
     def index(self, reponame=None, regen=False):
-        if reponame:
-            repo = get_repo(db(), reponame, create_ok=False)
+        if not reponame:
+            repos = db().query(AptRepo.name).order_by(AptRepo.name).all()
+            return ("<a href='/repo/apt/{name}'>{name}</a><br/>".format(name=repo.name) for repo in repos)
+
+        # the repo, its dists and their indexes in one query, with a row of nulls for a repo or dist with none
+        rows = db().query(AptRepo.name, AptDist.id, AptDist.name.label("dist"), AptIndex.component, AptIndex.arch) \
+            .outerjoin(AptDist, AptDist.repo_id == AptRepo.id) \
+            .outerjoin(AptIndex, AptIndex.dist_id == AptDist.id) \
+            .filter(AptRepo.name == reponame) \
+            .order_by(AptDist.name, AptIndex.component, AptIndex.arch).all()
+        if not rows:
+            raise cherrypy.HTTPError(404)
 
+        dists = [(dist_id, list(indexes)) for dist_id, indexes in groupby(rows, key=lambda row: row.id)
+                 if dist_id is not None]
+        if regen:
+            for dist_id, _ in dists:
+                self.base.regen_dist(dist_id)
+
+        def page():
+            reponame = rows[0].name
             yield "<a href='/repo/apt/{reponame}/pubkey'>pubkey</a> " \
-                  "<a href='/repo/apt/{reponame}?regen=1'>regen</a><hr/>".format(reponame=repo.name)
+                  "<a href='/repo/apt/{reponame}?regen=1'>regen</a><hr/>".format(reponame=reponame)
+            for _, indexes in dists:
+                yield "<a href='/repo/apt/{reponame}/dists/{name}'>{name}</a>: <a href='/repo/apt/{reponame}/dists/{name}/Release'>Release</a> <a href='/repo/apt/{reponame}/dists/{name}/Release.gpg'>Release.gpg</a> <a href='/repo/apt/{reponame}/dists/{name}/InRelease'>InRelease</a> <a href='/repo/apt/{reponame}/dists/{name}/install'>install</a>".format(reponame=reponame, name=indexes[0].dist)
+                for index in indexes:
+                    if index.component is None:
+                        continue
+                    yield " <a href='/repo/apt/{reponame}/dists/{name}/{index}/Packages'>{index}</a>" \
+                        .format(reponame=reponame, name=index.dist, index=index_directory(index.component, index.arch))
+                yield "<br />"
 
-            for dist in db().query(AptDist).filter(AptDist.repo == repo).order_by(AptDist.name).all():
-                yield "<a href='/repo/apt/{reponame}/dists/{name}'>{name}</a>: <a href='/repo/apt/{reponame}/dists/{name}/main/indexname/Packages'>Packages</a> <a href='/repo/apt/{reponame}/dists/{name}/Release'>Release</a> <a href='/repo/apt/{reponame}/dists/{name}/Release.gpg'>Release.gpg</a> <a href='/repo/apt/{reponame}/dists/{name}/install'>install</a><br />".format(reponame=repo.name, name=dist.name)
-                if regen:
-                    self.base.regen_dist(dist.id)
+        return page()
 
-            # yield "about apt repo '{}'".format(reponame)
-        else:
-            for repo in db().query(AptRepo).order_by(AptRepo.name).all():
-                yield "<a href='/repo/apt/{name}'>{name}</a><br/>".format(name=repo.name)
+    index._cp_config = {'response.stream': True}
 
     @cherrypy.expose
     def pubkey(self, reponame=None):
+        repo = db().query(AptRepo.gpgpubkey).filter(AptRepo.name == reponame).first()
+        if not repo:
+            raise cherrypy.HTTPError(404)
         cherrypy.response.headers['Content-Type'] = 'text/plain'
-        return get_repo(db(), reponame, create_ok=False).gpgpubkey
+        return repo.gpgpubkey
+
+
+"""dist metadata files served from the columns of AptDist holding them"""
+RELEASE_FILES = {"Release": AptDist.release_cache,
+                 "Release.gpg": AptDist.sig_cache,
+                 "InRelease": AptDist.inrelease_cache}
 
 
 @cherrypy.expose
@@ -358,50 +755,114 @@ class AptDists(object):
     def __init__(self, base):
         self.base = base
 
+    def _query(self, reponame, distname, *columns):
+        """
+        Query `columns` of a dist, and of anything joined to it, along with the dist's id and generation. Files are
+        looked up by repo and dist name in a single query.
+        """
+        return db().query(AptDist.id, AptDist.generation, *columns) \
+            .join(AptRepo, AptDist.repo_id == AptRepo.id) \
+            .filter(AptRepo.name == reponame,
+                    AptDist.name == distname)
+
     def __call__(self, *segments, reponame=None):
-        repo = get_repo(db(), reponame, create_ok=False)
+        key = (reponame, ) + segments
+        cached = self.base.cache.get(key)
+        if cached is not None:
+            set_route("metadata-cached")
+            cherrypy.response.headers['Content-Type'] = cached[0]
+            return cached[1]
+        epoch = self.base.cache.epoch
+
+        if len(segments) == 4 and segments[3] in ["Packages" + suffix for suffix in compressors.keys()]:
+            distname, componentname, indexname, fname = segments
+            set_route("metadata")
+
+            index_file = self._query(reponame, distname, AptIndexFile.data) \
+                .join(AptIndexFile, AptIndexFile.dist_id == AptDist.id) \
+                .filter(AptIndexFile.path == "/".join(segments[1:]),
+                        AptIndexFile.current == True).first()
+            if not index_file:
+                raise cherrypy.HTTPError(404)
 
-        if len(segments) == 4 and segments[3] == "Packages":
-            distname, componentname, indexname, pkgs = segments
-            dist = get_dist(db(), repo, distname, create_ok=False)
+            return self._respond(key, epoch, content_types[fname[len("Packages"):]], index_file.data, index_file)
 
-            if not repo or not dist:
+        elif len(segments) == 6 and segments[3] == "by-hash":
+            distname, componentname, indexname, _, algoname, digest = segments
+            set_route("metadata")
+            algo = {v: k for k, v in algos.items()}.get(algoname)
+            if not algo:
                 raise cherrypy.HTTPError(404)
 
-            cherrypy.response.headers['Content-Type'] = 'text/plain'
-            return dist.packages_cache
+            index_file = self._query(reponame, distname, AptIndexFile.path, AptIndexFile.data) \
+                .join(AptIndexFile, AptIndexFile.dist_id == AptDist.id) \
+                .filter(AptIndexFile.path.startswith("{}/{}/".format(componentname, indexname)),
+                        getattr(AptIndexFile, algo) == digest).first()
+            if not index_file:
+                raise cherrypy.HTTPError(404)
+
+            return self._respond(key, epoch, content_types[os.path.splitext(index_file.path)[1]], index_file.data)
+
+        elif len(segments) == 2 and segments[1] in RELEASE_FILES:
+            distname, target = segments
+            set_route("metadata")
+            dist = self._query(reponame, distname, RELEASE_FILES[target].label("body")).first()
+            if not dist:
+                raise cherrypy.HTTPError(404)
+
+            return self._respond(key, epoch, 'text/plain', dist.body, dist)
 
-        elif len(segments) == 2:
+        elif len(segments) == 2 and segments[1] == "install":
             distname, target = segments
-            dist = get_dist(db(), repo, distname, create_ok=False)
+            set_route("install")
+            dist = self._query(reponame, distname, AptRepo.name.label("repo"), AptDist.name).first()
+            if not dist:
+                raise cherrypy.HTTPError(404)
 
             cherrypy.response.headers['Content-Type'] = 'text/plain'
-            if target == "Release":
-                return dist.release_cache
-            elif target == "Release.gpg":
-                return dist.sig_cache
-            elif target == "install":
 
-                return """#!/bin/sh -ex
+            components = [row[0] for row in db().query(distinct(AptIndex.component))
+                          .filter(AptIndex.dist_id == dist.id).order_by(AptIndex.component).all()] or ["main"]
+
+            return """#!/bin/sh -ex
 wget -qO- {scheme}://{host}/repo/apt/{reponame}/pubkey | apt-key add -
-echo 'deb {scheme}://{host}/repo/apt/{reponame}/ {dist} main' | tee /etc/apt/sources.list.d/{reponame}-{dist}.list
+echo 'deb {scheme}://{host}/repo/apt/{reponame}/ {dist} {components}' | tee /etc/apt/sources.list.d/{reponame}-{dist}.list
 apt-get update
-""".format(scheme=cherrypy.request.scheme, host=cherrypy.request.headers['Host'], reponame=repo.name, dist=dist.name)
-            else:
-                raise cherrypy.HTTPError(404)
+""".format(scheme=cherrypy.request.scheme, host=cherrypy.request.headers['Host'], reponame=dist.repo, dist=dist.name,
+           components=" ".join(components))
 
         elif len(segments) == 1:
             distname = segments[0]
-            dist = get_dist(db(), repo, distname, create_ok=False)
-            body = ""
-            for package in db().query(AptPackage).filter(AptPackage.repo == repo,
-                                                         AptPackage.dist == dist).order_by(AptPackage.fname).all():
-                body += "<a href='/repo/apt/{reponame}/packages/{dist.name}/{fname[0]}/{fname}'>{fname}</a><br />" \
-                    .format(reponame=repo.name, dist=dist, fname=package.fname)
-            return body
+            set_route("listing")
+            dist = self._query(reponame, distname, AptRepo.name.label("repo"), AptDist.name).first()
+            if not dist:
+                raise cherrypy.HTTPError(404)
+
+            packages = db().query(AptPackage.fname).filter(AptPackage.dist_id == dist.id) \
+                .order_by(AptPackage.fname).all()
+
+            return ("<a href='/repo/apt/{reponame}/packages/{dist}/{fname[0]}/{fname}'>{fname}</a><br />"
+                    .format(reponame=dist.repo, dist=dist.name, fname=package.fname) for package in packages)
 
         raise cherrypy.HTTPError(404)
 
+    __call__._cp_config = {'response.stream': True}
+
+    def _respond(self, key, epoch, content_type, body, dist=None):
+        """
+        Return a metadata file, keeping it in the provider's metadata cache until the dist is regenerated. Files that
+        change when `dist` is regenerated are only cached if they were read from the dist's latest generation, which a
+        lagging replica database may not have yet.
+        """
+        if body is None:
+            raise cherrypy.HTTPError(404)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        if dist is None or self.base.generations.get(dist.id) == dist.generation:
+            self.base.cache.put(key, (content_type, body), len(body), epoch)
+        cherrypy.response.headers['Content-Type'] = content_type
+        return body
+
 
 @cherrypy.expose
 class AptFiles(object):
@@ -412,6 +873,25 @@ class AptFiles(object):
 
     def __call__(self, *segments, reponame=None):
         distname, firstletter, pkgname = segments
+
+        if cherrypy.request.method in ("GET", "HEAD"):
+            set_route("download")
+            package = db().query(AptRepo.name.label("repo"), AptDist.name.label("dist"), AptPackage.fname,
+                                 AptPackage.size, AptPackage.sha256) \
+                .join(AptDist, AptPackage.dist_id == AptDist.id) \
+                .join(AptRepo, AptPackage.repo_id == AptRepo.id) \
+                .filter(AptRepo.name == reponame,
+                        AptDist.name == distname,
+                        AptPackage.fname == pkgname).first()
+            if not package:
+                raise cherrypy.HTTPError(404)
+
+            return self.base.blobs.serve(os.path.join(self.base.basepath,
+                                                      package_blobpath(package.repo, package.dist, package.fname)),
+                                         "application/x-debian-package", package.size, sha256=package.sha256,
+                                         immutable=True)
+
+        set_route("delete")
         repo = get_repo(db(), reponame, create_ok=False)
         dist = get_dist(db(), repo, distname, create_ok=False)
         package = db().query(AptPackage).filter(AptPackage.repo == repo,
@@ -426,24 +906,11 @@ class AptFiles(object):
         if cherrypy.request.method == "DELETE":
             db().delete(package)
             self.base.s3.delete_object(Bucket=self.base.bucket, Key=dpath)
+            dist.dirty = True
             db().commit()
+            self.base.regen_dist(dist.id, (package.component, package.arch))
             return
 
-        elif cherrypy.request.method not in ("GET", "HEAD"):
-            raise cherrypy.HTTPError(405)
-
-        response = self.base.s3.get_object(Bucket=self.base.bucket, Key=dpath)
-
-        def stream():
-            while True:
-                data = response["Body"].read(65535)
-                if not data:
-                    return
-                yield data
-
-        cherrypy.response.headers["Content-Type"] = "application/x-debian-package"
-        cherrypy.response.headers["Content-Length"] = response["ContentLength"]
-
-        return stream()
+        raise cherrypy.HTTPError(405)
 
     __call__._cp_config = {'response.stream': True}
@@ -0,0 +1,140 @@
+import hashlib
+import os
+import traceback
+from collections import OrderedDict
+from tempfile import NamedTemporaryFile
+from threading import Lock
+
+
+class BlobFill(object):
+    def __init__(self, cache, name, sha256, size):
+        """
+        A cache entry being written as its object is streamed to a client. The entry only becomes visible once all of
+        it has been written and its hash checked.
+        """
+        self.cache = cache
+        self.name = name
+        self.sha256 = sha256
+        self.size = size
+        self.hash = hashlib.sha256()
+        self.written = 0
+        self.f = NamedTemporaryFile(dir=cache.path, prefix="tmp-", delete=False)
+
+    def write(self, data):
+        self.f.write(data)
+        self.hash.update(data)
+        self.written += len(data)
+
+    def commit(self):
+        self.f.close()
+        if self.written != self.size or self.hash.hexdigest() != self.sha256:
+            print(f"not caching {self.name}, its contents don't match the expected size or hash")
+            return self.abort()
+        self.cache._add(self.name, self.f.name, self.size)
+        self.f = None
+
+    def abort(self):
+        if self.f is not None:
+            self.f.close()
+            os.unlink(self.f.name)
+            self.f = None
+
+
+class BlobCache(object):
+    def __init__(self, path, max_bytes, accel_prefix=None):
+        """
+        Keeps copies of recently downloaded objects in a local directory, holding at most `max_bytes` and evicting the
+        least recently used first. Entries are keyed by object key and sha256, so an object that is replaced with
+        different contents is never served from a stale entry. If `accel_prefix` is set, hits are handed to a fronting
+        nginx that serves `path` under that location instead of being read by this process.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.accel_prefix = accel_prefix
+        self.lock = Lock()
+        """file name -> size"""
+        self.entries = OrderedDict()
+        self.size = 0
+
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """
+        Pick up entries left by a previous run, oldest first, and remove partially written ones
+        """
+        files = []
+        for name in os.listdir(self.path):
+            fpath = os.path.join(self.path, name)
+            if name.startswith("tmp-"):
+                os.unlink(fpath)
+                continue
+            stat = os.stat(fpath)
+            files.append((stat.st_mtime, name, stat.st_size))
+
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.size += size
+        self._evict()
+
+    @staticmethod
+    def entry_name(key, sha256):
+        return "{}-{}".format(hashlib.sha1(key.encode("utf-8")).hexdigest(), sha256)
+
+    def open(self, key, sha256):
+        """
+        Return the cached copy of an object opened for reading, and the name of its entry, or (None, None)
+        """
+        name = self.entry_name(key, sha256)
+        with self.lock:
+            if name not in self.entries:
+                return None, None
+            self.entries.move_to_end(name)
+            fpath = os.path.join(self.path, name)
+            try:
+                os.utime(fpath)  # keeps the lru order across restarts
+                return open(fpath, "rb"), name
+            except FileNotFoundError:
+                self.size -= self.entries.pop(name)
+                return None, None
+
+    def fill(self, key, sha256, size):
+        """
+        Start caching an object, returning a BlobFill to write its contents to, or None if it shouldn't be cached
+        """
+        if size > self.max_bytes:
+            return None
+        name = self.entry_name(key, sha256)
+        with self.lock:
+            if name in self.entries:
+                return None
+        try:
+            return BlobFill(self, name, sha256, size)
+        except OSError:
+            traceback.print_exc()
+            return None
+
+    def _add(self, name, tmppath, size):
+        with self.lock:
+            if name in self.entries:  # filled concurrently by another download
+                os.unlink(tmppath)
+                return
+            os.rename(tmppath, os.path.join(self.path, name))
+            self.entries[name] = size
+            self.size += size
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes:
+            name, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries),
+                    "bytes": self.size,
+                    "max_bytes": self.max_bytes}
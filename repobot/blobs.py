@@ -0,0 +1,177 @@
+import cherrypy
+from cherrypy.lib.httputil import get_ranges
+from urllib.parse import quote
+from repobot.upload import PART_SIZE, S3Upload
+
+
+"""ways package downloads can be answered:
+- proxy: stream the object from s3 through this process
+- redirect: redirect the client to a short lived presigned s3 url
+- accel: have a fronting nginx send the object, via an X-Accel-Redirect to an internal location that proxies the bucket
+"""
+DOWNLOAD_MODES = ["proxy", "redirect", "accel"]
+
+
+def get_range(size, etag=None):
+    """
+    Return the (start, stop) slice of an object of `size` bytes that the current request's Range header asks for, or
+    None if the whole object should be sent. Requests for several ranges also get the whole object, as do requests
+    whose If-Range doesn't match the object's `etag`.
+    """
+    header = cherrypy.request.headers.get("Range")
+    if not header or size is None or not header.startswith("bytes="):
+        return None
+
+    if_range = cherrypy.request.headers.get("If-Range")
+    if if_range and (not etag or if_range != etag):
+        return None
+
+    try:
+        ranges = get_ranges(header, size)
+    except ValueError:
+        return None
+
+    if ranges is None or len(ranges) > 1:
+        return None
+    if not ranges:
+        cherrypy.response.headers["Content-Range"] = "bytes */{}".format(size)
+        raise cherrypy.HTTPError(416)
+
+    start, stop = ranges[0]
+    return start, min(stop, size)
+
+
+class BlobStore(object):
+    def __init__(self, s3client, bucket, mode="proxy", presign_client=None, url_expires=300, accel_prefix="/_blobs/",
+                 cache=None, part_size=PART_SIZE, upload_concurrency=4):
+        """
+        Serves objects in the s3 bucket to http clients, and uploads them. `presign_client` is the s3 client used to
+        sign redirect urls, which must be configured with an endpoint clients can reach; it defaults to `s3client`. In
+        proxy mode, objects with a known hash are served from and added to the BlobCache `cache`, if given.
+        """
+        assert(mode in DOWNLOAD_MODES), f"unknown download mode {mode}"
+        self.s3 = s3client
+        self.bucket = bucket
+        self.mode = mode
+        self.presign = presign_client or s3client
+        self.url_expires = url_expires
+        self.accel_prefix = accel_prefix
+        self.cache = cache
+        self.part_size = part_size
+        self.upload_concurrency = upload_concurrency
+
+    def upload(self, key):
+        """
+        Return a S3Upload that streams into the object at `key`
+        """
+        return S3Upload(self.s3, self.bucket, key, part_size=self.part_size, concurrency=self.upload_concurrency)
+
+    def serve(self, key, content_type, size=None, sha256=None, immutable=False):
+        """
+        Respond to the current request with the object at `key`. HEAD requests are answered without touching s3 when
+        the object's `size` is known, and single byte ranges are supported when it is. The object's `sha256` is used as
+        its ETag, so clients can revalidate it with If-None-Match. Objects whose contents never change under the same
+        key, such as versioned package files, can be marked `immutable` to let caches keep them indefinitely.
+        """
+        request = cherrypy.request
+        response = cherrypy.response
+
+        if size is not None:
+            response.headers["Accept-Ranges"] = "bytes"
+        if immutable:
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+
+        etag = None
+        if sha256:
+            etag = response.headers["ETag"] = '"{}"'.format(sha256)
+            cherrypy.lib.cptools.validate_etags()
+
+        if request.method == "HEAD" and size is not None:
+            response.headers["Content-Type"] = content_type
+            response.headers["Content-Length"] = size
+            return []
+
+        if self.mode == "redirect":
+            url = self.presign.generate_presigned_url("get_object",
+                                                      Params={"Bucket": self.bucket,
+                                                              "Key": key,
+                                                              "ResponseContentType": content_type},
+                                                      ExpiresIn=self.url_expires)
+            raise cherrypy.HTTPRedirect(url, 302)
+
+        if self.mode == "accel":
+            response.headers["Content-Type"] = content_type
+            response.headers["X-Accel-Redirect"] = self.accel_prefix + quote(key)
+            return []
+
+        byterange = get_range(size, etag)
+
+        cached = None
+        if self.cache and sha256:
+            cached, name = self.cache.open(key, sha256)
+        if cached:
+            return self._serve_cached(cached, name, content_type, size, byterange)
+
+        args = {"Bucket": self.bucket, "Key": key}
+        if byterange:
+            args["Range"] = "bytes={}-{}".format(byterange[0], byterange[1] - 1)
+
+        s3response = self.s3.get_object(**args)
+        if byterange:
+            response.status = 206
+            response.headers["Content-Range"] = "bytes {}-{}/{}".format(byterange[0], byterange[1] - 1, size)
+        response.headers["Content-Type"] = content_type
+        response.headers["Content-Length"] = s3response["ContentLength"]
+
+        # whole objects are copied into the cache as they're sent
+        fill = None
+        if self.cache and sha256 and not byterange:
+            fill = self.cache.fill(key, sha256, size)
+
+        def stream():
+            try:
+                while True:
+                    data = s3response["Body"].read(65535)
+                    if not data:
+                        break
+                    if fill:
+                        fill.write(data)
+                    yield data
+                if fill:
+                    fill.commit()
+            finally:
+                if fill:
+                    fill.abort()
+                s3response["Body"].close()
+
+        return stream()
+
+    def _serve_cached(self, f, name, content_type, size, byterange):
+        response = cherrypy.response
+        response.headers["Content-Type"] = content_type
+
+        if self.cache.accel_prefix:
+            f.close()
+            response.headers["X-Accel-Redirect"] = self.cache.accel_prefix + name
+            return []
+
+        start, stop = byterange or (0, size)
+        if byterange:
+            response.status = 206
+            response.headers["Content-Range"] = "bytes {}-{}/{}".format(start, stop - 1, size)
+        response.headers["Content-Length"] = stop - start
+        f.seek(start)
+
+        def stream():
+            remaining = stop - start
+            try:
+                while remaining > 0:
+                    data = f.read(min(remaining, 256 * 1024))
+                    if not data:
+                        return
+                    remaining -= len(data)
+                    yield data
+            finally:
+                f.close()
+
+        return stream()
@@ -0,0 +1,54 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    def __init__(self, max_bytes):
+        """
+        Thread safe cache of tuple keys to values, holding at most `max_bytes` worth of values and evicting the least
+        recently used entries first.
+
+        Values loaded from elsewhere should be stored with the `epoch` read before loading them; an invalidation that
+        happens while the value is being loaded bumps the epoch and the stale value is then not stored.
+        """
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        """key -> (value, size)"""
+        self.entries = OrderedDict()
+        self.size = 0
+        self.epoch = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size, epoch):
+        with self.lock:
+            if epoch != self.epoch or size > self.max_bytes:
+                return
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+
+    def invalidate(self, *prefix):
+        """
+        Drop all entries whose key starts with `prefix`
+        """
+        with self.lock:
+            self.epoch += 1
+            for key in [key for key in self.entries.keys() if key[0:len(prefix)] == prefix]:
+                self.size -= self.entries.pop(key)[1]
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries),
+                    "bytes": self.size,
+                    "max_bytes": self.max_bytes}
@@ -1,7 +1,130 @@
 #!/usr/bin/env python3
 
+import glob
+import os
 import requests
+import sys
 import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+"""file name endings of each provider's packages, which are picked out of directories given to upload"""
+EXTENSIONS = {"apt": ".deb",
+              "pypi": ".whl",
+              "tar": ".tar.gz"}
+
+
+class MultipartBody(object):
+    def __init__(self):
+        """
+        File-like multipart/form-data body whose files are read from disk as it is sent, rather than the whole body
+        being built in memory first
+        """
+        self.boundary = uuid.uuid4().hex
+        """bytes to send, or paths of files to send, ending with the closing delimiter"""
+        self.segments = [f"--{self.boundary}--\r\n".encode("ascii")]
+        self.length = len(self.segments[0])
+        """position of the next byte to send, as the segment and offset within it"""
+        self.index = 0
+        self.offset = 0
+        self.file = None
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def add_field(self, name, value):
+        data = f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode("utf-8")
+        self.segments.insert(-1, data)
+        self.length += len(data)
+
+    def add_file(self, name, path):
+        head = (f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+                f'filename="{os.path.basename(path)}"\r\n'
+                f'Content-Type: application/octet-stream\r\n\r\n').encode("utf-8")
+        self.segments[-1:-1] = [head, path, b"\r\n"]
+        self.length += len(head) + os.path.getsize(path) + 2
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        out = bytearray()
+        while self.index < len(self.segments) and (size < 0 or len(out) < size):
+            want = size - len(out) if size >= 0 else -1
+            segment = self.segments[self.index]
+            if isinstance(segment, bytes):
+                data = segment[self.offset:self.offset + want] if want >= 0 else segment[self.offset:]
+                self.offset += len(data)
+                done = self.offset >= len(segment)
+            else:
+                if self.file is None:
+                    self.file = open(segment, "rb")
+                data = self.file.read(want)
+                done = not data
+                if done:
+                    self.file.close()
+                    self.file = None
+            out += data
+            if done:
+                self.index += 1
+                self.offset = 0
+        return bytes(out)
+
+
+def find_files(patterns, provider):
+    """
+    Expand the files, globs and directories given to upload into a sorted list of files. Directories are searched
+    recursively for the provider's packages.
+    """
+    paths = set()
+    for pattern in patterns:
+        matches = [pattern] if os.path.exists(pattern) else glob.glob(pattern, recursive=True)
+        assert(matches), f"no files match {pattern}"
+        for match in matches:
+            if os.path.isdir(match):
+                for root, _, files in os.walk(match):
+                    paths.update(os.path.join(root, fname) for fname in files
+                                 if fname.endswith(EXTENSIONS[provider]))
+            else:
+                paths.add(match)
+    return sorted(paths)
+
+
+def package_params(provider, path, name=None, version=None):
+    """
+    Return the name and version to upload a package with. Apt packages and wheels carry their own; tarballs need them
+    given, or taken from a file name of the form <name>-<version>.tar.gz.
+    """
+    if name or version:
+        return {key: value for key, value in (("name", name), ("version", version)) if value}
+    if provider != "tar":
+        return {}
+    fname = os.path.basename(path)
+    assert(fname.endswith(".tar.gz") and "-" in fname), f"can't tell the name and version of {fname}, pass -p and -i"
+    name, version = fname[:-len(".tar.gz")].rsplit("-", 1)
+    return {"name": name, "version": version}
+
+
+def upload(server, params, paths, batch):
+    """
+    Upload the packages `paths`, given as (path, params) with the parameters of each package, in one request. A batch
+    is sent as a streamed multipart form and committed as one by the server; otherwise there must be one package,
+    which is sent as the raw request body.
+    """
+    if not batch:
+        (path, package), = paths
+        with open(path, "rb") as f:
+            return requests.post(f"{server}/addpkg", params=dict(params, filename=os.path.basename(path), **package),
+                                 data=f, headers={"Content-Type": "application/octet-stream"})
+
+    body = MultipartBody()
+    for path, package in paths:
+        for key, value in package.items():
+            body.add_field(key, value)
+        body.add_file("f", path)
+    return requests.post(f"{server}/addpkgs", params=params, data=body, headers={"Content-Type": body.content_type})
 
 
 def main():
@@ -11,20 +134,24 @@ def main():
 
     subparser_action = parser.add_subparsers(dest='action', help='action')
 
-    subparser_upload = subparser_action.add_parser('upload', help='upload package to repository')
-    subparser_upload.add_argument('-y', '--provider', required=True, help="packaging provider")
-    subparser_upload.add_argument('-f', '--file', required=True, help="file to upload")
+    subparser_upload = subparser_action.add_parser('upload', help='upload packages to repository')
+    subparser_upload.add_argument('-y', '--provider', required=True, choices=EXTENSIONS.keys(),
+                                  help="packaging provider")
+    subparser_upload.add_argument('-f', '--file', required=True, nargs="+",
+                                  help="files, globs or directories to upload")
     subparser_upload.add_argument('-r', '--repo', required=True, help="repo name")
-    subparser_upload.add_argument('-p', '--package', required=True, help="package name")
-    subparser_upload.add_argument('-i', '--package-version', required=True, help="package version")
+    subparser_upload.add_argument('-p', '--package', help="package name, if uploading a single file")
+    subparser_upload.add_argument('-i', '--package-version', help="package version, if uploading a single file")
     subparser_upload.add_argument('-a', '--args', nargs="+", help="extra args")
+    subparser_upload.add_argument('-c', '--concurrency', default=4, type=int, help="number of uploads to run at once")
+    subparser_upload.add_argument('-b', '--batch-size', default=1, type=int,
+                                  help="packages to send per request, committed together and regenerating the repo's "
+                                       "metadata once. 0 sends all of them in one request")
 
     args = parser.parse_args()
 
     params = {"provider": args.provider,
-              "reponame": args.repo,
-              "name": args.package,
-              "version": args.package_version}
+              "reponame": args.repo}
 
     if args.args:
         for entry in args.args:
@@ -33,12 +160,30 @@ def main():
                 parser.error(f"duplicate parameter '{key}'")
             params[key] = value
 
-    endpoint = f'{args.server}/addpkg'
-    resp = requests.post(endpoint, params=params, files={'f': open(args.file, 'rb')})
-
     try:
-        resp.raise_for_status()
-    except Exception:
-        traceback.print_exc()
+        paths = find_files(args.file, args.provider)
+        if not paths:
+            parser.error(f"no {EXTENSIONS[args.provider]} files found to upload")
+        if len(paths) > 1 and (args.package or args.package_version):
+            parser.error("-p and -i can only be given when uploading a single file")
+        paths = [(path, package_params(args.provider, path, args.package, args.package_version)) for path in paths]
+    except AssertionError as e:
+        parser.error(str(e))
+
+    size = args.batch_size or len(paths)
+    batches = [paths[i:i + size] for i in range(0, len(paths), size)]
+
+    failed = False
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = [pool.submit(upload, args.server, params, batch, args.batch_size != 1) for batch in batches]
+        for batch, future in zip(batches, futures):
+            try:
+                resp = future.result()
+                print(resp.text)
+                resp.raise_for_status()
+            except Exception:
+                failed = True
+                print("failed to upload {}".format(", ".join(path for path, _ in batch)), file=sys.stderr)
+                traceback.print_exc()
 
-    print(resp.text)
+    sys.exit(1 if failed else 0)
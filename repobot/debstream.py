@@ -0,0 +1,84 @@
+import os
+import tarfile
+from email import message_from_string
+from io import BytesIO
+
+
+AR_MAGIC = b"!<arch>\n"
+AR_HEADER_SIZE = 60
+REQUIRED_FIELDS = ["Package", "Version", "Architecture"]
+
+
+def parse_control(member_name, data):
+    """
+    Extract the control file from a deb's control.tar member and parse it
+    """
+    assert(not member_name.endswith(".zst")), "zstd compressed control members are not supported"
+
+    with tarfile.open(fileobj=BytesIO(data), mode="r:*") as tar:
+        for member in tar.getmembers():
+            if member.isfile() and os.path.normpath(member.name) == "control":
+                message = message_from_string(tar.extractfile(member).read().decode("UTF-8"))
+                missing = [field for field in REQUIRED_FIELDS if field not in message]
+                assert(not missing), f"Required control fields missing: {missing}"
+                return message
+
+    assert(False), "control file not found in control member"
+
+
+class DebControlReader(object):
+    def __init__(self, max_control_size=16 * 1024 * 1024):
+        """
+        Parses a .deb package, which is an ar archive, incrementally as its bytes are fed in and extracts the control
+        file from the control.tar member. Only the control member is buffered; any member before it is skipped.
+        """
+        self.max_control_size = max_control_size
+        self.buf = bytearray()
+        self.magic = False
+        """name and remaining size, including padding, of the member being read"""
+        self.member = None
+        self.remaining = 0
+        """the parsed control file once it has been found"""
+        self.control = None
+
+    def feed(self, data):
+        if self.control is not None:
+            return
+        self.buf += data
+
+        while self.control is None:
+            if not self.magic:
+                if len(self.buf) < len(AR_MAGIC):
+                    return
+                assert(self.buf[:len(AR_MAGIC)] == AR_MAGIC), "not a deb package"
+                del self.buf[:len(AR_MAGIC)]
+                self.magic = True
+
+            elif self.member is None:
+                if len(self.buf) < AR_HEADER_SIZE:
+                    return
+                header = bytes(self.buf[:AR_HEADER_SIZE])
+                del self.buf[:AR_HEADER_SIZE]
+                assert(header[58:60] == b"`\n"), "corrupt ar member header"
+
+                self.member = header[0:16].decode("ascii").strip().rstrip("/")
+                size = int(header[48:58].decode("ascii").strip())
+                if self.member.startswith("control.tar"):
+                    assert(size <= self.max_control_size), "control member is too large"
+                    self.remaining = size
+                else:
+                    self.remaining = size + size % 2  # members are padded to an even size
+
+            elif self.member.startswith("control.tar"):
+                if len(self.buf) < self.remaining:
+                    return
+                self.control = parse_control(self.member, bytes(self.buf[:self.remaining]))
+                self.buf = bytearray()
+
+            else:
+                skipped = min(self.remaining, len(self.buf))
+                del self.buf[:skipped]
+                self.remaining -= skipped
+                if self.remaining:
+                    return
+                self.member = None
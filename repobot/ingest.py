@@ -0,0 +1,112 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from sqlalchemy.exc import IntegrityError
+from threading import Lock
+from repobot.tracing import span
+
+
+"""uploaded packages are read from the request body in chunks of this size"""
+READ_CHUNK = 1024 * 1024
+
+"""buffers at least this large have each of their digests computed on a separate thread. hashlib releases the GIL
+while hashing anything over 2KB, but handing small buffers to other threads costs more than it saves."""
+PARALLEL_MIN = 64 * 1024
+
+"""digests are only computed in parallel when there are cores to run them on"""
+PARALLEL = (os.cpu_count() or 1) > 1
+
+_pool = None
+_pool_lock = Lock()
+
+
+def hash_pool():
+    """
+    Return the thread pool shared by all MultiHashers, creating it on first use
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=min(8, os.cpu_count()), thread_name_prefix="hash")
+        return _pool
+
+
+class MultiHasher(object):
+    def __init__(self, algos):
+        """
+        Computes several hashlib digests, named by `algos`, over the same data. Large buffers are hashed by every
+        digest at once, one thread each.
+        """
+        self.hashes = {algo: getattr(hashlib, algo)() for algo in algos}
+        self.size = 0
+
+    def update(self, data):
+        self.size += len(data)
+        hashes = list(self.hashes.values())
+        with span("hash"):
+            if not PARALLEL or len(hashes) == 1 or len(data) < PARALLEL_MIN:
+                for h in hashes:
+                    h.update(data)
+                return
+
+            # the calling thread takes the first digest rather than sitting idle
+            data = memoryview(data)
+            futures = [hash_pool().submit(h.update, data) for h in hashes[1:]]
+            hashes[0].update(data)
+            for future in futures:
+                future.result()
+
+    def hexdigests(self):
+        return {algo: h.hexdigest() for algo, h in self.hashes.items()}
+
+
+def hashmany(data, algos):
+    """
+    Hash the input data using several algos
+    """
+    hasher = MultiHasher(algos)
+    hasher.update(data)
+    return hasher.hexdigests()
+
+
+def copyhash(fin, fouts, algos=("sha256", )):
+    """
+    Copy the file-like `fin` into each of the writable `fouts`, such as a S3Upload or local file, hashing it with
+    `algos` while doing so. Returns the hex digests, by algo, and size of the data copied. Outputs are not closed.
+    """
+    hasher = MultiHasher(algos)
+
+    while True:
+        with span("read"):
+            data = fin.read(READ_CHUNK)
+        if not data:
+            break
+        hasher.update(data)
+        with span("write"):
+            for fout in fouts:
+                fout.write(data)
+
+    return hasher.hexdigests(), hasher.size
+
+
+@contextmanager
+def committing(session, s3, bucket, keys):
+    """
+    Commit `session` at the end of the block. If the block or the commit fails, the session is rolled back and the s3
+    objects at `keys`, which the block may go on adding to as it stores uploads, are deleted, so that a failed upload
+    leaves nothing behind. The exception is a commit that breaks a unique constraint: a concurrent upload of the same
+    package got there first and its row points at the same keys, so they are left alone, at the cost of leaving the
+    objects of any other packages in the batch orphaned.
+    """
+    try:
+        yield
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        raise
+    except Exception:
+        session.rollback()
+        for key in keys:
+            s3.delete_object(Bucket=bucket, Key=key)
+        raise
@@ -0,0 +1,180 @@
+import cherrypy
+import time
+from prometheus_client import Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+from threading import local
+
+
+REQUEST_SECONDS = Histogram("repobot_http_request_duration_seconds",
+                            "Time from receiving a request until its response has been sent",
+                            ["provider", "route", "method"])
+REQUESTS = Counter("repobot_http_requests_total", "Requests answered",
+                   ["provider", "route", "method", "status"])
+REQUEST_DB_QUERIES = Histogram("repobot_http_request_db_queries", "Database queries made by each request",
+                               ["provider", "route"], buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100, 250, 1000))
+REQUEST_DB_SECONDS = Histogram("repobot_http_request_db_duration_seconds",
+                               "Time each request spent waiting for database queries", ["provider", "route"])
+
+DB_QUERY_SECONDS = Histogram("repobot_db_query_duration_seconds",
+                             "Duration of database queries, made while answering requests or in the background",
+                             ["context"])
+
+S3_SECONDS = Histogram("repobot_s3_request_duration_seconds",
+                       "Duration of s3 calls, up to the response headers for calls whose response body is streamed",
+                       ["operation"])
+S3_REQUESTS = Counter("repobot_s3_requests_total", "s3 calls made, by http status", ["operation", "status"])
+S3_BYTES = Counter("repobot_s3_bytes_total", "Object bytes sent to and received from s3",
+                   ["operation", "direction"])
+
+REGEN_SECONDS = Histogram("repobot_regen_duration_seconds", "Duration of regen queue runs",
+                          ["queue", "outcome"], buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+SIGN_SECONDS = Histogram("repobot_apt_sign_duration_seconds", "Time spent signing apt Release files")
+
+
+"""database queries made and time spent on them by the request being handled on this thread, if any"""
+_request = local()
+
+
+def set_route(route, provider=None):
+    """
+    Label the current request's metrics with `route`, and `provider` if given, instead of the name of the handler and
+    application that answered it. Handlers that serve several kinds of resource use this to tell them apart.
+    """
+    request = cherrypy.request
+    request.metrics_route = route
+    if provider:
+        request.metrics_provider = provider
+
+
+class MetricsTool(cherrypy.Tool):
+    def __init__(self):
+        """
+        Records the latency, status and database use of every request. Requests are labelled with the provider whose
+        application answered them, named after its mount point, and the route set by set_route(), which defaults to
+        the handler's name. Timing ends once the response has been sent, so streamed bodies are included.
+        """
+        cherrypy.Tool.__init__(self, 'on_start_resource', self.start_request, priority=10)
+
+    def _setup(self):
+        cherrypy.Tool._setup(self)
+        cherrypy.request.hooks.attach('on_end_request', self.end_request, priority=90)
+
+    def start_request(self):
+        # before other tools, such as response encoding, wrap the handler
+        handler = getattr(cherrypy.request.handler, "callable", None)
+        cherrypy.request.metrics_handler = getattr(handler, "__qualname__", "none")
+        _request.queries = 0
+        _request.db_seconds = 0.0
+        _request.active = True
+
+    def end_request(self):
+        _request.active = False
+        request = cherrypy.request
+        response = cherrypy.response
+
+        provider = getattr(request, "metrics_provider", None) or \
+            (request.script_name.rsplit("/", 1)[-1] if request.script_name else "app")
+        route = getattr(request, "metrics_route", None) or getattr(request, "metrics_handler", "none")
+
+        REQUEST_SECONDS.labels(provider, route, request.method).observe(time.time() - response.time)
+        REQUESTS.labels(provider, route, request.method, str(response.status).split(" ", 1)[0]).inc()
+        REQUEST_DB_QUERIES.labels(provider, route).observe(_request.queries)
+        REQUEST_DB_SECONDS.labels(provider, route).observe(_request.db_seconds)
+
+
+def _before_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info["metrics_query_start"] = time.perf_counter()
+
+
+def _after_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info.pop("metrics_query_start", time.perf_counter())
+    in_request = getattr(_request, "active", False)
+    DB_QUERY_SECONDS.labels("request" if in_request else "background").observe(elapsed)
+    if in_request:
+        _request.queries += 1
+        _request.db_seconds += elapsed
+
+
+def instrument_engine(engine):
+    """
+    Time every query made through the sqlalchemy `engine`, and count them against the request making them
+    """
+    event.listen(engine, "before_cursor_execute", _before_query)
+    event.listen(engine, "after_cursor_execute", _after_query)
+
+
+def _before_s3(model, params, context, **kwargs):
+    context["metrics_start"] = time.perf_counter()
+    body = params.get("body")
+    if hasattr(body, "getbuffer"):  # botocore may have wrapped the bytes given to it in a BytesIO
+        body = body.getbuffer()
+    if isinstance(body, (bytes, bytearray, memoryview)) and body:
+        S3_BYTES.labels(model.name, "sent").inc(len(body))
+
+
+def _after_s3(http_response, parsed, model, context, **kwargs):
+    S3_SECONDS.labels(model.name).observe(time.perf_counter() - context.get("metrics_start", time.perf_counter()))
+    S3_REQUESTS.labels(model.name, str(http_response.status_code)).inc()
+    if model.name == "GetObject" and http_response.status_code < 300:
+        S3_BYTES.labels(model.name, "received").inc(parsed.get("ContentLength") or 0)
+
+
+def instrument_s3(client):
+    """
+    Time every call made with the boto3 s3 `client`, and count the object bytes sent and received by it
+    """
+    client.meta.events.register("before-call.s3", _before_s3)
+    client.meta.events.register("after-call.s3", _after_s3)
+
+
+class ServerCollector(object):
+    def __init__(self, providers):
+        """
+        Reports state that is read when metrics are scraped rather than recorded as it changes: the http server's
+        worker threads and the regen queues of `providers` that have one
+        """
+        self.providers = providers
+
+    def describe(self):
+        # registering the collector asks it for its metric names, before the database tables may exist
+        for name in ("repobot_http_threads", "repobot_http_threads_max", "repobot_http_queued_connections",
+                     "repobot_regen_jobs", "repobot_regen_lag_seconds"):
+            yield GaugeMetricFamily(name, "")
+
+    def collect(self):
+        pool = getattr(cherrypy.server.httpserver, "requests", None)
+        if pool is not None:
+            threads = GaugeMetricFamily("repobot_http_threads", "http worker threads, by state", labels=["state"])
+            idle = pool.idle
+            threads.add_metric(["busy"], len(pool._threads) - idle)
+            threads.add_metric(["idle"], idle)
+            yield threads
+            if 0 < pool.max < float("inf"):
+                yield GaugeMetricFamily("repobot_http_threads_max", "most http worker threads that can be started",
+                                        value=pool.max)
+            yield GaugeMetricFamily("repobot_http_queued_connections",
+                                    "connections waiting for a free http worker thread", value=pool.qsize)
+
+        jobs = GaugeMetricFamily("repobot_regen_jobs", "keys waiting in or being run by regen queues, across all "
+                                 "nodes. Retrying keys are also counted as pending", labels=["queue", "state"])
+        lag = GaugeMetricFamily("repobot_regen_lag_seconds",
+                                "age of the oldest submission to a regen queue not yet reflected by a finished run",
+                                labels=["queue"])
+        for provider in self.providers.values():
+            scheduler = getattr(provider, "scheduler", None)
+            if scheduler is None:
+                continue
+            stats = scheduler.stats()
+            for state in ("pending", "running", "retrying"):
+                jobs.add_metric([scheduler.name, state], stats[state])
+            lag.add_metric([scheduler.name], max(stats["lag"].values(), default=0))
+        yield jobs
+        yield lag
+
+
+def render():
+    """
+    Return the content type and body of the metrics page
+    """
+    return CONTENT_TYPE_LATEST, generate_latest(REGISTRY)
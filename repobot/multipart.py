@@ -0,0 +1,131 @@
+from cherrypy.lib.httputil import HeaderElement
+from repobot.ingest import READ_CHUNK
+
+
+"""most bytes a part's header lines, or the value of a form field, may take"""
+MAX_FIELD_SIZE = 64 * 1024
+
+
+class Part(object):
+    def __init__(self, reader, headers):
+        """
+        One part of a multipart body, whose content is read from the body as it arrives. Stands in for a multipart file
+        field parsed by cherrypy, being its own `file`.
+        """
+        self.reader = reader
+        self.headers = headers
+        disposition = HeaderElement.from_str(headers.get("content-disposition", ""))
+        self.name = disposition.params.get("name")
+        self.filename = disposition.params.get("filename")
+        self.file = self
+
+    def read(self, size=-1):
+        return self.reader.read_part(size)
+
+
+class MultipartReader(object):
+    def __init__(self, fp, boundary, chunk_size=READ_CHUNK):
+        """
+        Reads a multipart/form-data body from the file-like `fp` one part at a time, as it is received, rather than
+        spooling every part to a temp file before the handler runs like cherrypy does. A part's content must be read
+        before moving on to the next part; whatever is left of it unread is skipped.
+        """
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.delimiter = b"\r\n--" + boundary.encode("ascii")
+        # the first delimiter isn't preceded by a line break, adding one lets it be found like the others
+        self.buf = bytearray(b"\r\n")
+        self.eof = False
+        """whether read_part() is in the content of a part, rather than at its closing delimiter"""
+        self.in_part = False
+
+    def _fill(self):
+        data = self.fp.read(self.chunk_size)
+        if not data:
+            self.eof = True
+        self.buf += data
+
+    def read_part(self, size=-1):
+        """
+        Read up to `size` bytes of the current part's content, or all of it if `size` is negative. Returns b"" at the
+        end of the part.
+        """
+        if not self.in_part:
+            return b""
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read_part(self.chunk_size), b""))
+
+        while True:
+            end = self.buf.find(self.delimiter)
+            if end >= 0:
+                available = end
+                break
+            # the end of the buffer may be the start of a delimiter, the rest is content
+            available = len(self.buf) - len(self.delimiter) + 1
+            if available >= size:
+                break
+            assert(not self.eof), "multipart body is truncated"
+            self._fill()
+
+        if end == 0:
+            self.in_part = False
+            return b""
+        data = bytes(self.buf[:min(size, available)])
+        del self.buf[:len(data)]
+        return data
+
+    def _readline(self):
+        while True:
+            end = self.buf.find(b"\r\n")
+            if end >= 0:
+                line = bytes(self.buf[:end])
+                del self.buf[:end + 2]
+                return line
+            assert(len(self.buf) <= MAX_FIELD_SIZE), "multipart headers are too long"
+            assert(not self.eof), "multipart body is truncated"
+            self._fill()
+
+    def __iter__(self):
+        """
+        Yield each part of the body in turn
+        """
+        while True:
+            # skip the preamble, or what wasn't read of the previous part
+            self.in_part = True
+            while self.read_part(self.chunk_size):
+                pass
+            del self.buf[:len(self.delimiter)]
+
+            while len(self.buf) < 2 and not self.eof:
+                self._fill()
+            if self.buf[:2] == b"--":
+                return  # the closing delimiter, anything after it is ignored
+            self._readline()
+
+            headers = {}
+            size = 0
+            while True:
+                line = self._readline()
+                if not line:
+                    break
+                size += len(line)
+                assert(size <= MAX_FIELD_SIZE), "multipart headers are too long"
+                key, _, value = line.decode("utf-8").partition(":")
+                headers[key.strip().lower()] = value.strip()
+
+            self.in_part = True
+            yield Part(self, headers)
+
+    def files(self, params):
+        """
+        Yield (part, params) for each file in the body. Form fields that aren't files set parameters of the files after
+        them, on top of `params`.
+        """
+        params = dict(params)
+        for part in self:
+            if part.filename is None:
+                value = part.read(MAX_FIELD_SIZE + 1)
+                assert(len(value) <= MAX_FIELD_SIZE), f"form field {part.name} is too long"
+                params[part.name] = value.decode("utf-8")
+            else:
+                yield part, dict(params)
@@ -0,0 +1,27 @@
+"""cache headers of published objects whose contents never change under the same key"""
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+"""cache headers of published objects that are replaced as the repo changes, so caches revalidate them on every use"""
+MUTABLE = "no-cache"
+
+
+class Publisher(object):
+    def __init__(self, s3client, bucket):
+        """
+        Writes generated index files to the s3 bucket, next to the packages they list, so that the bucket can be served
+        as a static repo by a CDN or web server. Each object is replaced with a single put, so readers see either the
+        old or the new version of it; callers order their puts so that a file is in place before anything refers to
+        it.
+        """
+        self.s3 = s3client
+        self.bucket = bucket
+
+    def put(self, key, body, content_type, immutable=False):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        response = self.s3.put_object(Bucket=self.bucket, Key=key, Body=body, ContentType=content_type,
+                                      CacheControl=IMMUTABLE if immutable else MUTABLE)
+        assert(response["ResponseMetadata"]["HTTPStatusCode"] == 200), f"Publish failed: {response}"
+
+    def delete(self, key):
+        self.s3.delete_object(Bucket=self.bucket, Key=key)
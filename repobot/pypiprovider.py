@@ -5,16 +5,34 @@ import os
 import re
 from email import message_from_string
 from jinja2 import Environment, FileSystemLoader, select_autoescape
-from sqlalchemy import Column, ForeignKey, UniqueConstraint
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, ForeignKey, Index, UniqueConstraint
+from sqlalchemy.orm import deferred, relationship
 from sqlalchemy.types import String, Integer, Text
 from tempfile import TemporaryDirectory
 from wheel import wheelfile
-from repobot.tables import Base, db
+from repobot.blobs import BlobStore
+from repobot.cache import LRUCache
+from repobot.ingest import committing, copyhash
+from repobot.metrics import set_route
+from repobot.tables import Base, ProjectTable, added_columns, added_indexes, db, db_primary, get_or_create, \
+    natural_keys
+from repobot.tracing import span
 
 
 APPROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "../"))
 
+"""media types the simple index can be requested as (PEP 691), mapped to the format that is served for them. The first
+is the default for clients that accept anything."""
+SIMPLE_MEDIA = {"text/html": "html",
+                "application/vnd.pypi.simple.v1+html": "v1+html",
+                "application/vnd.pypi.simple.latest+html": "v1+html",
+                "application/vnd.pypi.simple.v1+json": "v1+json",
+                "application/vnd.pypi.simple.latest+json": "v1+json"}
+
+SIMPLE_CONTENT_TYPES = {"html": "text/html; charset=utf-8",
+                        "v1+html": "application/vnd.pypi.simple.v1+html",
+                        "v1+json": "application/vnd.pypi.simple.v1+json"}
+
 
 def parse_wheel(path):
     fsize = os.path.getsize(path)
@@ -36,7 +54,8 @@ def parse_wheel(path):
     assert(metadata_file), "METADATA file not found"
     assert(metadata_wheel), "WHEEL file not found"
 
-    metadata_data = message_from_string(p.read(metadata_file.filename).decode("UTF-8"))
+    metadata_raw = p.read(metadata_file.filename)
+    metadata_data = message_from_string(metadata_raw.decode("UTF-8"))
     wheel_data = message_from_string(p.read(metadata_wheel.filename).decode("UTF-8"))
 
     # get version and whatnot from the pkginfo. there will be multiple Tags with the same python and api, but
@@ -80,34 +99,20 @@ def parse_wheel(path):
             "metadata": metadata_data.items(),
             "description": metadata_data.get_payload(),
             "wheelname": wheelname,
-            "size": fsize}
+            "size": fsize,
+            "metadata_file": metadata_raw}
 
 
 def normalize(name):
     return re.sub(r"[-_.]+", "-", name).lower()
 
 
-# https://stackoverflow.com/a/5967539
-def sort_atoi(text):
-    return int(text) if text.isdigit() else text
-
-
-def natural_keys(text):
-    """
-    Sort keeping keys in "natural" order such that version names embedded in strings are ordered correctly such as:
-    - macosx_10_6_intel
-    - macosx_10_9_intel
-    - macosx_10_9_x86_64
-    - macosx_10_10_intel
-    - macosx_10_10_x86_64
-    """
-    return [sort_atoi(c) for c in re.split(r'(\d+)', text)]
-
-
 class PipRepo(Base):
     __tablename__ = 'piprepo'
     id = Column(Integer, primary_key=True)
     name = Column(String(length=32), unique=True, nullable=False)
+    # incremented whenever the repo's contents change
+    generation = Column(Integer, nullable=False, default=0, server_default="0")
 
 
 class PipPackage(Base):
@@ -132,101 +137,224 @@ class PipPackage(Base):
     size = Column(Integer, nullable=False)
     sha256 = Column(String(length=64))
 
-    fields = Column(Text())
+    fields = deferred(Column(Text()))
+
+    metadata_sha256 = Column(String(length=64), nullable=True)  # hash of the METADATA sidecar, if we have one
 
-    __table_args__ = (UniqueConstraint('fname', 'repo_id', name='pip_unique_repopkg'), )
+    __table_args__ = (UniqueConstraint('fname', 'repo_id', name='pip_unique_repopkg'),
+                      Index('pip_repo_distnorm', 'repo_id', 'dist_norm'), )
 
     @property
     def blobpath(self):
-        return os.path.join("repos", self.repo.name, "packages", self.name[0], self.fname)
+        return wheel_blobpath(self.repo.name, self.fname)
+
+
+added_columns(PipRepo, "generation")
+added_columns(PipPackage, "metadata_sha256")
+added_indexes(PipPackage, "pip_repo_distnorm")
+
+
+def wheel_blobpath(reponame, fname):
+    """
+    Return the path of a wheel within the provider's s3 base path, repos/<reponame>/wheels/f/foo.whl
+    """
+    return os.path.join("repos", reponame, "wheels", fname[0].lower(), fname)
+
+
+class PipProject(Base):
+    """
+    One row per distinct dist in a repo, kept up to date by `projects`
+    """
+    __tablename__ = 'pipproject'
+    id = Column(Integer, primary_key=True)
+
+    repo_id = Column(Integer, ForeignKey("piprepo.id"), nullable=False)
+    repo = relationship("PipRepo")
+
+    dist = Column(String(length=128), nullable=False)       # 'requests', as spelled by the latest version
+    dist_norm = Column(String(length=128), nullable=False)  # 'requests'
+    count = Column(Integer, nullable=False)                 # number of packages
+    latest = Column(String(length=64), nullable=False)      # '2.14.2'
+
+    __table_args__ = (UniqueConstraint('repo_id', 'dist_norm', name='pip_unique_repoproject'), )
 
 
 def get_repo(_db, repo_name, create_ok=True):
     """
     Fetch a repo from the database by name
     """
-    repo = _db.query(PipRepo).filter(PipRepo.name == repo_name).first()
-    if not repo and create_ok:
-        repo = PipRepo(name=repo_name)
-        _db.add(repo)
-        _db.commit()
-    return repo
+    return get_or_create(_db, PipRepo, create_ok, name=repo_name)
 
 
-def copysha256(fin, fout):
+def touch_repo(_db, repo):
     """
-    Copy a file and calculate sha256 while doing so
+    Mark a repo's contents as changed, which invalidates the index pages clients have cached
     """
-    h = hashlib.sha256()
+    _db.query(PipRepo).filter(PipRepo.id == repo.id) \
+        .update({PipRepo.generation: PipRepo.generation + 1}, synchronize_session=False)
 
-    while True:
-        data = fin.read(4096)
-        if not data:
-            break
-        h.update(data)
-        fout.write(data)
 
-    return h.hexdigest()
+projects = ProjectTable(PipPackage, PipProject, "dist_norm", copy=("dist", ), touch=touch_repo)
 
 
 class PypiProvider(object):
-    def __init__(self, dbcon, s3client, bucket):
+    def __init__(self, dbcon, s3client, bucket, cache_size=64 * 1024 * 1024, blobs=None, publisher=None):
         self.db = dbcon
         self.s3 = s3client
         self.bucket = bucket
         """base path within the s3 bucket"""
         self.basepath = "data/provider/pip"
-
-        cherrypy.tree.mount(PipWeb(self), "/repo/pypi", {'/': {'tools.trailing_slash.on': False,
-                                                               'tools.db.on': True}})
+        """answers package downloads"""
+        self.blobs = blobs or BlobStore(s3client, bucket)
+        """rendered index pages, keyed by (repo name, repo generation, dist name, format)"""
+        self.cache = LRUCache(cache_size)
+        """ids of repos whose projects have been checked against their packages since startup"""
+        self.synced = set()
+        """writes the simple index to s3 for static serving, if set"""
+        self.publisher = publisher
+
+        self.web = PipWeb(self)
+        cherrypy.tree.mount(self.web, "/repo/pypi", {'/': {'tools.trailing_slash.on': False,
+                                                           'tools.db.on': True}})
+
+    def publish(self, repo, *dist_norms):
+        """
+        Write the simple index pages of a repo and of the given projects, or all of them if none are given, to s3 under
+        repos/<reponame>/simple/. Pages link to the repo's wheels/ by relative path. A project's page is written before
+        the repo's page links to it, and removed after the repo's page stops linking to it.
+        """
+        if not self.publisher:
+            return
+        prefix = os.path.join(self.basepath, "repos", repo.name, "simple")
+
+        if not dist_norms:
+            dist_norms = [row.dist_norm for row in db().query(PipProject.dist_norm)
+                          .filter(PipProject.repo_id == repo.id).all()]
+            gone = []
+        else:
+            present = {row.dist_norm for row in db().query(PipPackage.dist_norm).distinct()
+                       .filter(PipPackage.repo == repo, PipPackage.dist_norm.in_(dist_norms)).all()}
+            gone = [name for name in dist_norms if name not in present]
+            dist_norms = [name for name in dist_norms if name in present]
+
+        for name in dist_norms:
+            self.publisher.put(os.path.join(prefix, name, "index.html"),
+                               self.web._render_dist(repo, name, "html", static=True), SIMPLE_CONTENT_TYPES["html"])
+        self.publisher.put(os.path.join(prefix, "index.html"), self.web._render_repo(repo, "html", static=True),
+                           SIMPLE_CONTENT_TYPES["html"])
+        for name in gone:
+            self.publisher.delete(os.path.join(prefix, name, "index.html"))
+
+    def _ingest(self, repo, fobj, version=None, pending=()):
+        """
+        Stream a wheel to s3, returning its row, not yet added to the session, its s3 path, its metadata and its
+        METADATA file. `version`, if given, must match the wheel's. `pending` holds the file names of wheels that are
+        about to be added alongside it.
+        """
+        assert(fobj.filename.endswith(".whl") and os.path.basename(fobj.filename) == fobj.filename), \
+            "file name is invalid"
+
+        # the file name is checked against the wheel's metadata before the upload is completed
+        dpath = os.path.join(self.basepath, wheel_blobpath(repo.name, fobj.filename))
+
+        files = self.s3.list_objects(Bucket=self.bucket, Prefix=dpath).get("Contents")
+        if files:
+            print(f"will overwrite: {files}")
+
+        # the wheel is streamed to s3 as it is received. reading its metadata needs random access to the zip, so a copy
+        # is also kept in temp storage.
+        upload = self.blobs.upload(dpath)
+        try:
+            with TemporaryDirectory() as tdir:
+                tmppkgpath = os.path.join(tdir, fobj.filename)
+                with open(tmppkgpath, "wb") as fdest, span("copy"):
+                    hashes, _ = copyhash(fobj.file, [upload, fdest])
+
+                with span("parse"):
+                    metadata = parse_wheel(tmppkgpath)
+
+            metadata_file = metadata.pop("metadata_file")
+            assert(version is None or version == metadata["fields"]["version"]), \
+                "wheel metadata version doesn't match supplied version"
+            assert(fobj.filename == metadata["wheelname"]), f"file name is invalid, wanted '{metadata['wheelname']}'"
+            assert(metadata["wheelname"] not in pending and
+                   not db().query(PipPackage).filter(PipPackage.repo == repo,
+                                                     PipPackage.fname == metadata["wheelname"]).first()), \
+                f"{metadata['wheelname']} already exists in {repo.name}"
+
+            with span("write"):
+                upload.close()
+        except Exception:
+            upload.abort()
+            raise
+
+        pkg = PipPackage(repo=repo,
+                         dist=metadata["fields"]["dist"],
+                         dist_norm=normalize(metadata["fields"]["dist"]),
+                         version=metadata["fields"]["version"],
+                         build=metadata["fields"]["build"],
+                         python=metadata["fields"]["python"],
+                         api=metadata["fields"]["api"],
+                         platform=metadata["fields"]["platform"],
+                         fname=metadata["wheelname"],
+                         size=metadata["size"],
+                         sha256=hashes["sha256"],
+                         fields=json.dumps(metadata),
+                         metadata_sha256=hashlib.sha256(metadata_file).hexdigest())
+        return pkg, dpath, metadata, metadata_file
+
+    def _put_metadata(self, dpath, metadata_file):
+        """
+        Store a wheel's METADATA file next to the wheel at `dpath`, so pip can resolve dependencies without fetching
+        the wheel itself (PEP 658). It is stored before the wheel is committed, so failing to store it fails the upload.
+        """
+        response = self.s3.put_object(Body=metadata_file, Bucket=self.bucket, Key=dpath + ".metadata")
+        assert(response["ResponseMetadata"]["HTTPStatusCode"] == 200), f"Upload failed: {response}"
 
     def web_addpkg(self, reponame, name, version, fobj):
         repo = get_repo(db(), reponame)
+        pkg, dpath, metadata, metadata_file = self._ingest(repo, fobj, version)
 
-        # write wheel to temp storage
-        with TemporaryDirectory() as tdir:
-            tmppkgpath = os.path.join(tdir, fobj.filename)  #TODO verify filename doesnt have any nonsense like ../../passwd
-            with open(tmppkgpath, "wb") as fdest:
-                shasum = copysha256(fobj.file, fdest)
-
-            metadata = parse_wheel(tmppkgpath)
-            assert(version == metadata["fields"]["version"]), "wheel metadata version doesn't match supplied version"
-            assert(fobj.filename == metadata["wheelname"]), f"file name is invalid, wanted '{metadata['wheelname']}'"
-
-            # s3 path - repos/<reponame>/wheels/f/foo.wheel
-            dpath = os.path.join(self.basepath, "repos", repo.name, "wheels",
-                                 metadata["wheelname"][0].lower(), metadata["wheelname"])
-
-            files = self.s3.list_objects(Bucket=self.bucket, Prefix=dpath).get("Contents")
-            if files:
-                print(f"will overwrite: {files}")
-
-            # add to db
-            pkg = PipPackage(repo=repo,
-                             dist=metadata["fields"]["dist"],
-                             dist_norm=normalize(metadata["fields"]["dist"]),  # index me ?
-                             version=metadata["fields"]["version"],
-                             build=metadata["fields"]["build"],
-                             python=metadata["fields"]["python"],
-                             api=metadata["fields"]["api"],
-                             platform=metadata["fields"]["platform"],
-                             fname=metadata["wheelname"],
-                             size=metadata["size"],
-                             sha256=shasum,
-                             fields=json.dumps(metadata))
+        with committing(db(), self.s3, self.bucket, [dpath, dpath + ".metadata"]):
+            self._put_metadata(dpath, metadata_file)
             db().add(pkg)
-            db().commit()
 
-            try:
-                with open(tmppkgpath, "rb") as f:
-                    response = self.s3.put_object(Body=f, Bucket=self.bucket, Key=dpath)
-                    assert(response["ResponseMetadata"]["HTTPStatusCode"] == 200), f"Upload failed: {response}"
-            except Exception:
-                db().delete(pkg)
-                db().commit()
-                raise
+        # bumps the repo's generation, so cached pages are replaced
+        projects.update(db(), repo, normalize(metadata["fields"]["dist"]))
+        self.cache.invalidate(repo.name)
+        self.publish(repo, normalize(metadata["fields"]["dist"]))
 
-            return json.dumps(metadata, indent=4)
+        return json.dumps(metadata, indent=4)
+
+    def web_addpkgs(self, reponame, uploads):
+        """
+        Add many wheels to a repo, committing them together once all have been stored. `uploads` yields (file, params)
+        for each wheel, where params are those of web_addpkg; the version may be left out. If any wheel fails, none are
+        added.
+        """
+        repo = get_repo(db(), reponame)
+        pkgs = []
+        fnames = set()
+        dpaths = []
+        output = []
+        dist_norms = set()
+        with committing(db(), self.s3, self.bucket, dpaths):
+            for fobj, params in uploads:
+                pkg, dpath, metadata, metadata_file = self._ingest(repo, fobj, params.get("version"), pending=fnames)
+                pkgs.append(pkg)
+                fnames.add(pkg.fname)
+                dpaths += [dpath, dpath + ".metadata"]
+                self._put_metadata(dpath, metadata_file)
+                dist_norms.add(pkg.dist_norm)
+                output.append(metadata)
+
+            db().add_all(pkgs)
+
+        projects.update(db(), repo, *dist_norms)
+        self.cache.invalidate(repo.name)
+        self.publish(repo, *dist_norms)
+
+        return json.dumps(output, indent=4)
 
 
 @cherrypy.popargs("reponame", "distname", "filename")
@@ -240,69 +368,167 @@ class PipWeb(object):
         self.tpl.filters.update(normalize=normalize)
 
     @cherrypy.expose
-    def index(self, reponame=None, distname=None, filename=None):
+    def index(self, reponame=None, distname=None, filename=None, format=None, publish=False):
         if filename:
             return self.handle_download(reponame, distname, filename)
+        elif publish and reponame and not distname:
+            # writes to s3 and the database, so it mustn't be reachable by links, crawlers or caches replaying a GET
+            if cherrypy.request.method != "POST":
+                raise cherrypy.HTTPError(405)
+            set_route("publish")
+            repo = get_repo(db(), reponame, create_ok=False)
+            if not repo or not self.base.publisher:
+                raise cherrypy.HTTPError(404)
+            if repo.id not in self.base.synced:
+                projects.sync(db(), repo)
+                self.base.synced.add(repo.id)
+            self.base.publish(repo)
+            return "OK"
         else:
-            return self.handle_navigation(reponame, distname, filename)
+            return self.handle_navigation(reponame, distname, filename, format)
 
-    def handle_navigation(self, reponame=None, distname=None, filename=None):
+    def handle_navigation(self, reponame=None, distname=None, filename=None, format=None):
+        set_route("project" if distname else "repo" if reponame else "root")
         if reponame:
             repo = get_repo(db(), reponame, create_ok=False)
-            if distname:
-                return self.tpl.get_template("pypi/dist.html") \
-                    .render(repo=repo,
-                            pkgs=db().query(PipPackage).filter(PipPackage.repo == repo,
-                                                               PipPackage.dist_norm == distname).
-                            order_by(PipPackage.version).all(),
-                            distname=normalize(distname))
-
-            return self.tpl.get_template("pypi/repo.html") \
-                .render(repo=repo,
-                        dists=self._get_dists(repo))
+            if not repo:
+                raise cherrypy.HTTPError(404)
+
+            if repo.id not in self.base.synced:
+                projects.sync(db_primary(), repo)
+                self.base.synced.add(repo.id)
+
+            # pages only change when the repo's generation does, so clients can revalidate them with If-None-Match
+            fmt = self._negotiate(format)
+            cherrypy.response.headers["Vary"] = "Accept"
+            cherrypy.response.headers["Content-Type"] = SIMPLE_CONTENT_TYPES[fmt]
+            cherrypy.response.headers["ETag"] = '"{}-{}-{}"'.format(repo.id, repo.generation, fmt.replace("+", "-"))
+            cherrypy.lib.cptools.validate_etags()
+
+            key = (repo.name, repo.generation, distname, fmt)
+            epoch = self.base.cache.epoch
+            page = self.base.cache.get(key)
+            if page is None:
+                if distname:
+                    page = self._render_dist(repo, distname, fmt)
+                else:
+                    page = self._render_repo(repo, fmt)
+                self.base.cache.put(key, page, len(page), epoch)
+            return page
 
         return self.tpl.get_template("pypi/root.html") \
-            .render(repos=db().query(PipRepo).order_by(PipRepo.name).all())
-
-    def _get_dists(self, repo):
-        lastdist = None
-        for dist in db().query(PipPackage).filter(PipPackage.repo == repo).order_by(PipPackage.dist).all():
-            if lastdist and dist.dist == lastdist:
-                continue
-            yield dist
-            lastdist = dist.dist
+            .render(repos=db().query(PipRepo.name).order_by(PipRepo.name).all())
+
+    def _negotiate(self, format=None):
+        """
+        Pick the format of the simple index to serve from the format query parameter or the Accept header
+        """
+        if format:
+            if format not in SIMPLE_MEDIA:
+                raise cherrypy.HTTPError(406)
+            return SIMPLE_MEDIA[format]
+        return SIMPLE_MEDIA[cherrypy.lib.cptools.accept(list(SIMPLE_MEDIA.keys()))]
+
+    def _render_dist(self, repo, distname, fmt, static=False):
+        """
+        Render a project's page of the simple index. `static` pages link to wheels by their path relative to the page's
+        published location rather than by their url on this server.
+        """
+        pkgs = db().query(PipPackage.fname, PipPackage.sha256, PipPackage.metadata_sha256) \
+            .filter(PipPackage.repo_id == repo.id,
+                    PipPackage.dist_norm == distname) \
+            .order_by(PipPackage.version, PipPackage.id).all()
+
+        def pkg_url(pkg):
+            if static:
+                return "../../wheels/{}/{}".format(pkg.fname[0].lower(), pkg.fname)
+            return "/repo/pypi/{}/{}/{}".format(repo.name, normalize(distname), pkg.fname)
+
+        if fmt == "v1+json":
+            files = []
+            for pkg in pkgs:
+                info = {"filename": pkg.fname,
+                        "url": pkg_url(pkg),
+                        "hashes": {"sha256": pkg.sha256}}
+                if pkg.metadata_sha256:
+                    info["core-metadata"] = info["dist-info-metadata"] = {"sha256": pkg.metadata_sha256}
+                files.append(info)
+            return json.dumps({"meta": {"api-version": "1.0"},
+                               "name": normalize(distname),
+                               "files": files}).encode("utf-8")
+
+        return self.tpl.get_template("pypi/dist.html") \
+            .render(repo=repo,
+                    pkgs=pkgs,
+                    pkg_url=pkg_url,
+                    distname=normalize(distname)).encode("utf-8")
+
+    def _render_repo(self, repo, fmt, static=False):
+        dists = db().query(PipProject.dist_norm).filter(PipProject.repo_id == repo.id) \
+            .order_by(PipProject.dist_norm).all()
+
+        if fmt == "v1+json":
+            return json.dumps({"meta": {"api-version": "1.0"},
+                               "projects": [{"name": dist.dist_norm} for dist in dists]}).encode("utf-8")
+
+        return self.tpl.get_template("pypi/repo.html") \
+            .render(repo=repo,
+                    base_url="" if static else "/repo/pypi/{}/".format(repo.name),
+                    dists=dists).encode("utf-8")
 
     def handle_download(self, reponame, distname, filename):
-        repo = get_repo(db(), reponame, create_ok=False)
-        pkg = db().query(PipPackage).filter(PipPackage.repo == repo, PipPackage.fname == filename).first()
+        is_metadata = filename.endswith(".whl.metadata")
+        if is_metadata:
+            filename = filename[0:-len(".metadata")]
+
+        method = str(cherrypy.request.method)
+        if method == "DELETE" and not is_metadata:
+            set_route("delete")
+            return self.handle_delete(reponame, filename)
+        elif method not in ("GET", "HEAD"):
+            raise cherrypy.HTTPError(405)
+        set_route("metadata" if is_metadata else "download")
+
+        pkg = db().query(PipRepo.name.label("repo"), PipPackage.fname, PipPackage.size, PipPackage.sha256,
+                         PipPackage.metadata_sha256) \
+            .join(PipRepo, PipPackage.repo_id == PipRepo.id) \
+            .filter(PipRepo.name == reponame,
+                    PipPackage.fname == filename).first()
         if not pkg:
             raise cherrypy.HTTPError(404)
 
-        dpath = os.path.join(self.base.basepath, "repos", repo.name, "wheels", pkg.fname[0].lower(), pkg.fname)
-
-        if str(cherrypy.request.method) == "DELETE":
-            db().delete(pkg)
-            files = self.base.s3.list_objects(Bucket=self.base.bucket, Prefix=dpath).get("Contents")
-            if files:
-                self.base.s3.delete_object(Bucket=self.base.bucket, Key=dpath)
-            db().commit()
-            return "OK"
-
-        elif str(cherrypy.request.method) == "GET":
-            response = self.base.s3.get_object(Bucket=self.base.bucket, Key=dpath)
+        dpath = os.path.join(self.base.basepath, wheel_blobpath(pkg.repo, pkg.fname))
 
+        if is_metadata:
+            if not pkg.metadata_sha256:  # uploaded before metadata files were kept
+                raise cherrypy.HTTPError(404)
+            if method == "HEAD":
+                response = self.base.s3.head_object(Bucket=self.base.bucket, Key=dpath + ".metadata")
+            else:
+                response = self.base.s3.get_object(Bucket=self.base.bucket, Key=dpath + ".metadata")
             cherrypy.response.headers["Content-Type"] = "binary/octet-stream"
             cherrypy.response.headers["Content-Length"] = response["ContentLength"]
+            return [] if method == "HEAD" else [response["Body"].read()]
 
-            def stream():
-                while True:
-                    data = response["Body"].read(65535)
-                    if not data:
-                        return
-                    yield data
+        return self.base.blobs.serve(dpath, "binary/octet-stream", pkg.size, sha256=pkg.sha256, immutable=True)
 
-            return stream()
-        else:
-            raise cherrypy.HTTPError(405)
+    def handle_delete(self, reponame, filename):
+        repo = get_repo(db(), reponame, create_ok=False)
+        pkg = db().query(PipPackage).filter(PipPackage.repo == repo, PipPackage.fname == filename).first()
+        if not pkg:
+            raise cherrypy.HTTPError(404)
+
+        dpath = os.path.join(self.base.basepath, pkg.blobpath)
+        dist_norm = pkg.dist_norm
+        db().delete(pkg)
+        db().commit()
+        projects.update(db(), repo, dist_norm)
+        self.base.cache.invalidate(repo.name)
+        # published pages stop linking to the wheel before it goes away
+        self.base.publish(repo, dist_norm)
+        files = self.base.s3.list_objects(Bucket=self.base.bucket, Prefix=dpath).get("Contents")
+        for obj in files or []:  # the wheel and its metadata file
+            self.base.s3.delete_object(Bucket=self.base.bucket, Key=obj["Key"])
+        return "OK"
 
     index._cp_config = {'response.stream': True}
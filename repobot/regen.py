@@ -0,0 +1,286 @@
+import json
+import os
+import socket
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import Column, UniqueConstraint, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.types import String, Integer, Float, Text
+from threading import Condition, Thread
+from uuid import uuid4
+from repobot.metrics import REGEN_SECONDS
+from repobot.tables import Base
+from repobot import tracing
+
+
+class RegenJob(Base):
+    """
+    A key waiting to be regenerated, or being regenerated by the node holding its lease. There is at most one row per
+    key; submissions for a key that already has one are merged into it.
+    """
+    __tablename__ = 'regenjob'
+    id = Column(Integer, primary_key=True)
+    queue = Column(String(length=32), nullable=False)  # 'apt'
+    key = Column(Integer, nullable=False)  # AptDist.id
+
+    hints = Column(Text(), nullable=True)  # json list of hints, or null to regenerate everything
+    first = Column(Float, nullable=False)  # oldest submission not yet reflected by a finished run
+    due = Column(Float, nullable=False)  # when the job can next be claimed
+    seq = Column(Integer, nullable=False, default=0)  # bumped by every submission
+
+    owner = Column(String(length=128), nullable=True)  # node holding the lease
+    lease = Column(Float, nullable=True)  # lease expiry; other nodes can claim the job after this
+    claimed = Column(Float, nullable=True)
+    claimed_seq = Column(Integer, nullable=True)
+    claimed_hints = Column(Text(), nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(Text(), nullable=True)
+
+    __table_args__ = (UniqueConstraint('queue', 'key', name='regen_unique_queuekey'), )
+
+
+def merge_hints(a, b):
+    """
+    Merge two json hint lists, either of which may be None meaning everything
+    """
+    if a is None or b is None:
+        return None
+    merged = json.loads(a)
+    merged += [hint for hint in json.loads(b) if hint not in merged]
+    return json.dumps(merged)
+
+
+def load_hints(hints):
+    """
+    Decode a json hint list into a set, or None. Lists don't survive json as tuples, so they're turned back into them.
+    """
+    if hints is None:
+        return None
+    return {tuple(hint) if isinstance(hint, list) else hint for hint in json.loads(hints)}
+
+
+class RegenQueue(object):
+    def __init__(self, name, func, Session, workers=4, delay=2.0, max_delay=30.0, lease=60.0, poll=1.0,
+                 max_attempts=5):
+        """
+        Run `func(key, hints)` for submitted keys on a bounded pool of worker threads, using a database table as the
+        queue so that any number of nodes sharing the database can work through it together.
+
+        Submissions for a key that is already queued are collapsed into a single run, which is passed the set of all
+        hints they were submitted with, or None if any of them was submitted without hints. Hints must be json
+        serializable. A queued key runs once `delay` seconds have passed without another submission for it, or once it
+        has been waiting for `max_delay` seconds.
+
+        A node claims a key by taking a lease on it, which it renews while the run is in progress, so a key never runs
+        concurrently with itself on any node. Keys whose node died are claimed by another node once their lease
+        expires. Submitting a key while it is running schedules one more run after the current one. Failed runs are
+        retried with a growing delay, up to `max_attempts` times.
+
+        Nodes poll the table every `poll` seconds for work, and are woken immediately by their own submissions.
+        """
+        self.name = name
+        self.func = func
+        self.Session = Session
+        self.workers = workers
+        self.delay = delay
+        self.max_delay = max_delay
+        self.lease = lease
+        self.poll = poll
+        self.max_attempts = max_attempts
+        self.node = "{}-{}-{}".format(socket.gethostname(), os.getpid(), uuid4().hex[:8])
+
+        self.lock = Condition()
+        """keys being run by this node"""
+        self.running = set()
+
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.dispatcher = Thread(target=self._dispatch, daemon=True)
+
+    def start(self):
+        """
+        Start claiming work. The job table must exist by now.
+        """
+        self.dispatcher.start()
+
+    def submit(self, key, *hints):
+        hints = json.dumps(list(hints)) if hints else None
+        session = self.Session()
+        try:
+            for _ in range(2):
+                now = time.time()
+                job = session.query(RegenJob).filter(RegenJob.queue == self.name,
+                                                     RegenJob.key == key).with_for_update().first()
+                if job:
+                    job.hints = merge_hints(job.hints, hints)
+                    job.due = min(now + self.delay, job.first + self.max_delay)
+                    job.seq += 1
+                else:
+                    session.add(RegenJob(queue=self.name, key=key, hints=hints, first=now, due=now + self.delay,
+                                         seq=0, attempts=0))
+                try:
+                    session.commit()
+                    break
+                except IntegrityError:
+                    # another node inserted the same key first, merge into its row instead
+                    session.rollback()
+                except StaleDataError:
+                    # the job finished and was deleted after we read it, on databases without row locks such as sqlite
+                    session.rollback()
+        finally:
+            session.close()
+
+        with self.lock:
+            self.lock.notify()
+
+    def _dispatch(self):
+        while True:
+            try:
+                self._renew()
+                self._claim()
+            except Exception:
+                traceback.print_exc()
+            with self.lock:
+                self.lock.wait(self.poll)
+
+    def _renew(self):
+        """
+        Extend the leases of keys this node is running
+        """
+        with self.lock:
+            running = list(self.running)
+        if not running:
+            return
+        session = self.Session()
+        try:
+            session.query(RegenJob) \
+                .filter(RegenJob.queue == self.name,
+                        RegenJob.key.in_(running),
+                        RegenJob.owner == self.node) \
+                .update({RegenJob.lease: time.time() + self.lease}, synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+
+    def _claim(self):
+        with self.lock:
+            free = self.workers - len(self.running)
+        if free <= 0:
+            return
+
+        session = self.Session()
+        try:
+            now = time.time()
+            candidates = session.query(RegenJob.id, RegenJob.key) \
+                .filter(RegenJob.queue == self.name,
+                        RegenJob.due <= now,
+                        or_(RegenJob.owner == None, RegenJob.lease < now)) \
+                .order_by(RegenJob.due).limit(free).all()
+
+            for candidate in candidates:
+                with self.lock:
+                    if candidate.key in self.running:
+                        continue
+                # claiming is a compare-and-set on the lease, so only one node wins a job
+                claimed = session.query(RegenJob) \
+                    .filter(RegenJob.id == candidate.id,
+                            or_(RegenJob.owner == None, RegenJob.lease < now)) \
+                    .update({RegenJob.owner: self.node,
+                             RegenJob.lease: now + self.lease,
+                             RegenJob.claimed: now,
+                             RegenJob.attempts: RegenJob.attempts + 1}, synchronize_session=False)
+                session.commit()
+                if not claimed:
+                    continue
+
+                # take the hints submitted so far, later submissions gather for another run
+                job = session.query(RegenJob).filter(RegenJob.id == candidate.id).with_for_update().first()
+                if job.claimed_seq is not None:
+                    # the previous claim's node died or stalled, its hints are still unhandled
+                    job.claimed_hints = merge_hints(job.claimed_hints, job.hints)
+                else:
+                    job.claimed_hints = job.hints
+                job.claimed_seq = job.seq
+                job.hints = "[]"
+                session.commit()
+
+                with self.lock:
+                    self.running.add(job.key)
+                self.pool.submit(self._run, job.id, job.key, job.claimed_seq, job.claimed_hints, job.attempts)
+        finally:
+            session.close()
+
+    def _run(self, job_id, key, seq, hints, attempts):
+        error = None
+        start = time.perf_counter()
+        tracing.begin(f"regen {self.name} {key}")
+        try:
+            self.func(key, load_hints(hints))
+        except Exception:
+            error = traceback.format_exc()
+            print(error)
+        finally:
+            tracing.end()
+        REGEN_SECONDS.labels(self.name, "error" if error else "ok").observe(time.perf_counter() - start)
+
+        session = self.Session()
+        try:
+            self._finish(session, job_id, seq, hints, attempts, error)
+        except Exception:
+            # the lease will run out and the job will be claimed again
+            traceback.print_exc()
+        finally:
+            session.close()
+            with self.lock:
+                self.running.discard(key)
+                self.lock.notify()
+
+    def _finish(self, session, job_id, seq, hints, attempts, error):
+        now = time.time()
+        job = session.query(RegenJob).filter(RegenJob.id == job_id,
+                                             RegenJob.owner == self.node).with_for_update().first()
+        if not job:
+            print(f"lost the lease on regen job {job_id} while running it")
+            return
+
+        if error is None:
+            if job.seq == seq:
+                session.delete(job)
+            else:
+                # submitted again while running, the new submissions still need a run
+                job.first = job.claimed
+                job.attempts = 0
+                job.owner = job.lease = job.claimed = job.claimed_seq = job.claimed_hints = job.error = None
+        elif attempts >= self.max_attempts:
+            print(f"giving up on {self.name} regen of {job.key} after {attempts} attempts")
+            session.delete(job)
+        else:
+            job.hints = merge_hints(job.hints, hints)
+            job.due = now + min(self.delay * 2 ** attempts, 300)
+            job.error = error
+            job.owner = job.lease = job.claimed = job.claimed_seq = job.claimed_hints = None
+        session.commit()
+
+    def stats(self):
+        """
+        Return the number of queued and running keys across all nodes and, for each of them, how many seconds ago the
+        oldest submission not yet reflected by a finished run was made
+        """
+        session = self.Session()
+        try:
+            now = time.time()
+            jobs = session.query(RegenJob.key, RegenJob.first, RegenJob.owner, RegenJob.lease, RegenJob.attempts) \
+                .filter(RegenJob.queue == self.name).all()
+        finally:
+            session.close()
+
+        running = [job for job in jobs if job.owner is not None and job.lease >= now]
+        with self.lock:
+            local = len(self.running)
+        return {"pending": len(jobs) - len(running),
+                "running": len(running),
+                "running_here": local,
+                "workers": self.workers,
+                "retrying": len([job for job in jobs if job.attempts and job.owner is None]),
+                "lag": {job.key: now - job.first for job in jobs}}
@@ -1,19 +1,36 @@
 import boto3
 import cherrypy
+import json
 import logging
 import os
 import sqlalchemy
 from botocore.client import Config as BotoConfig
-from repobot.aptprovider import AptProvider
+from repobot.aptprovider import DEFAULT_ARCHS, AptProvider
+from repobot.blobcache import BlobCache
+from repobot.blobs import BlobStore, DOWNLOAD_MODES
+from repobot.multipart import MultipartReader
+from repobot import metrics, tracing
+from repobot.publish import Publisher
 from repobot.pypiprovider import PypiProvider
 from repobot.tarprovider import TarProvider
 from repobot.tables import SAEnginePlugin, SATool
 from urllib.parse import urlparse
 
 
+class RawUpload(object):
+    def __init__(self, body, filename):
+        """
+        Stands in for a multipart file field when a package is sent as the raw request body, which cherrypy leaves
+        unread so it can be streamed straight to the provider
+        """
+        self.file = body
+        self.filename = filename
+
+
 class AppWeb(object):
-    def __init__(self, providers):
+    def __init__(self, providers, blobcache=None):
         self.providers = providers
+        self.blobcache = blobcache
 
     @cherrypy.expose
     def index(self):
@@ -25,10 +42,95 @@ class AppWeb(object):
             yield '<a href="/repo/{provider}">{provider}</a><br />'.format(provider=provider)
 
     @cherrypy.expose
-    def addpkg(self, provider, reponame, name, version, f, **params):
+    def status(self):
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        status = {name: provider.status() for name, provider in self.providers.items() if hasattr(provider, "status")}
+        if self.blobcache:
+            status["blob_cache"] = self.blobcache.stats()
+        return json.dumps(status, indent=4).encode("utf-8")
+
+    @cherrypy.expose
+    def metrics(self):
+        cherrypy.response.headers['Content-Type'], body = metrics.render()
+        return body
+
+    @cherrypy.expose
+    def addpkg(self, provider, reponame, name=None, version=None, f=None, **params):
         # TODO regex validate args
+        # an unknown provider mustn't become a metrics label
+        if provider not in self.providers:
+            raise cherrypy.HTTPError(404)
+        metrics.set_route("upload", provider=provider)
+        if f is None:
+            f = RawUpload(cherrypy.request.body, params.pop("filename", None))
         yield from self.providers[provider].web_addpkg(reponame, name, version, f, **params)
 
+    @cherrypy.expose
+    def addpkgs(self, provider, reponame, **params):
+        """
+        Add every file of a multipart form to a repo, committing them together. Form fields set the parameters of the
+        files after them, such as a tarball's name and version, and query parameters apply to all files. The form is
+        read as it is received and each file is streamed to the provider in turn, without spooling it to disk first.
+        """
+        if provider not in self.providers:
+            raise cherrypy.HTTPError(404)
+        metrics.set_route("batch upload", provider=provider)
+        content_type = cherrypy.request.body.content_type
+        assert(content_type.value == "multipart/form-data" and content_type.params.get("boundary")), \
+            "expected a multipart/form-data body"
+        reader = MultipartReader(cherrypy.request.body, content_type.params["boundary"])
+        yield from self.providers[provider].web_addpkgs(reponame, reader.files(params))
+
+    # leave the form unparsed, for the handler to stream
+    addpkgs._cp_config = {'request.body.processors': {}}
+
+
+def make_s3(url):
+    """
+    Create an s3 client from a http(s)://key:secret@host:port/bucket connection string, returning the client and the
+    bucket name
+    """
+    s3url = urlparse(url)
+    s3args = {"config": BotoConfig(signature_version='s3v4')}
+
+    endpoint_url = f"{s3url.scheme}://{s3url.hostname}"
+    if s3url.port:
+        endpoint_url += f":{s3url.port}"
+    s3args["endpoint_url"] = endpoint_url
+
+    if s3url.username and s3url.password:
+        s3args["aws_access_key_id"] = s3url.username
+        s3args["aws_secret_access_key"] = s3url.password
+
+    return boto3.client('s3', **s3args), s3url.path[1:]
+
+
+def make_engine(url, args):
+    """
+    Create a sqlalchemy engine whose connection pool is sized per the command line args. Connections are checked
+    before use and recycled periodically, so ones the server has timed out are never handed out.
+    """
+    options = {"echo": args.debug, "encoding": "utf8", "pool_pre_ping": True}
+    if not url.startswith("sqlite"):
+        options.update(pool_size=args.db_pool_size, max_overflow=args.db_max_overflow,
+                       pool_recycle=args.db_pool_recycle)
+    return sqlalchemy.create_engine(url, **options)
+
+
+def parse_download_modes(values, providers):
+    """
+    Parse --download-mode values, which are either a mode for all providers or provider=mode, into a dict of provider
+    name to mode
+    """
+    modes = {name: "proxy" for name in providers}
+    for value in values or []:
+        provider, _, mode = value.rpartition("=")
+        assert(mode in DOWNLOAD_MODES), f"unknown download mode {mode}"
+        assert(not provider or provider in providers), f"unknown provider {provider}"
+        for name in ([provider] if provider else providers):
+            modes[name] = mode
+    return modes
+
 
 def main():
     import argparse
@@ -38,8 +140,51 @@ def main():
     parser.add_argument('-p', '--port', default=8080, type=int, help="http port to listen on")
     parser.add_argument('-d', '--database', help="mysql+pymysql:// connection string",
                         default=os.environ.get("DATABASE_URL"))
+    parser.add_argument('--database-replica', default=os.environ.get("DATABASE_REPLICA_URL"),
+                        help="mysql+pymysql:// connection string of a read replica that GET requests are served from")
+    parser.add_argument('--db-pool-size', default=10, type=int,
+                        help="database connections to keep open, per database")
+    parser.add_argument('--db-max-overflow', default=10, type=int,
+                        help="further database connections that may be opened under load, per database")
+    parser.add_argument('--db-pool-recycle', default=3600, type=int,
+                        help="seconds after which database connections are replaced")
     parser.add_argument('-s', '--s3', help="http:// or https:// connection string",
                         default=os.environ.get("S3_URL"))
+    parser.add_argument('--regen-workers', default=4, type=int,
+                        help="number of apt dists whose metadata can be regenerated in parallel")
+    parser.add_argument('--regen-delay', default=2.0, type=float,
+                        help="seconds to wait for further uploads to a dist before regenerating its metadata")
+    parser.add_argument('--apt-archs', default=",".join(DEFAULT_ARCHS),
+                        help="comma separated architectures every apt dist publishes indexes for, in addition to those "
+                             "of the packages it contains")
+    parser.add_argument('--metadata-cache-size', default=64, type=int,
+                        help="megabytes of apt metadata and pypi index pages to keep cached in memory, each")
+    parser.add_argument('--download-mode', action="append",
+                        help="how package downloads are served: proxy (default), redirect to a presigned s3 url, or "
+                             "accel for an X-Accel-Redirect to a fronting nginx. Either a mode for all providers or "
+                             "provider=mode, may be repeated")
+    parser.add_argument('--s3-public-url', help="http:// or https:// s3 connection string that clients can reach, "
+                                                "used to sign redirect download urls. Defaults to --s3")
+    parser.add_argument('--download-url-expires', default=300, type=int,
+                        help="seconds redirect download urls are valid for")
+    parser.add_argument('--accel-prefix', default="/_blobs/",
+                        help="internal nginx location that object keys are appended to in accel download mode")
+    parser.add_argument('--blob-cache-dir', help="directory to keep local copies of recently downloaded packages in, "
+                                                 "for downloads served in proxy mode")
+    parser.add_argument('--blob-cache-size', default=1024, type=int,
+                        help="megabytes of packages to keep in --blob-cache-dir")
+    parser.add_argument('--blob-cache-accel-prefix',
+                        help="internal nginx location serving --blob-cache-dir; if set cached packages are sent by "
+                             "nginx via X-Accel-Redirect")
+    parser.add_argument('--upload-part-size', default=8, type=int,
+                        help="megabytes per part that uploaded packages are streamed to s3 in, at least 5")
+    parser.add_argument('--upload-concurrency', default=4, type=int,
+                        help="number of parts of each uploaded package that can be sent to s3 at once")
+    parser.add_argument('--publish', action="store_true",
+                        help="also write apt and pypi index files to s3 as they change, so the bucket can be served "
+                             "as a static repo")
+    parser.add_argument('--slow-request-log', type=float, metavar="SECONDS",
+                        help="log the span tree of requests and regens taking at least this many seconds")
     parser.add_argument('--debug', action="store_true", help="enable development options")
     args = parser.parse_args()
 
@@ -50,27 +195,31 @@ def main():
         parser.error("--database or DATABASE_URL required")
     if not args.s3:
         parser.error("--s3 or S3_URL required")
+    if args.upload_part_size < 5:
+        parser.error("--upload-part-size must be at least 5")
+    try:
+        download_modes = parse_download_modes(args.download_mode, ["apt", "pypi", "tar"])
+    except AssertionError as e:
+        parser.error(str(e))
 
     # set up database client
-    dbcon = sqlalchemy.create_engine(args.database, echo=args.debug, encoding="utf8")
-    SAEnginePlugin(cherrypy.engine, dbcon).subscribe()
+    dbcon = make_engine(args.database, args)
+    replica = make_engine(args.database_replica, args) if args.database_replica else None
+    for engine in (dbcon, replica):
+        if engine:
+            metrics.instrument_engine(engine)
+            tracing.instrument_engine(engine)
+    SAEnginePlugin(cherrypy.engine, dbcon, replica=replica).subscribe()
     cherrypy.tools.db = SATool()
+    cherrypy.tools.metrics = metrics.MetricsTool()
+    cherrypy.tools.tracing = tracing.TracingTool()
+    tracing.slow_threshold = args.slow_request_log
 
     # set up s3 client
-    s3url = urlparse(args.s3)
-    s3args = {"config": BotoConfig(signature_version='s3v4')}
-
-    endpoint_url = f"{s3url.scheme}://{s3url.hostname}"
-    if s3url.port:
-        endpoint_url += f":{s3url.port}"
-    s3args["endpoint_url"] = endpoint_url
-
-    if s3url.username and s3url.password:
-        s3args["aws_access_key_id"] = s3url.username
-        s3args["aws_secret_access_key"] = s3url.password
-
-    s3 = boto3.client('s3', **s3args)
-    bucket = s3url.path[1:]
+    s3, bucket = make_s3(args.s3)
+    metrics.instrument_s3(s3)
+    tracing.instrument_s3(s3)
+    presign_s3 = make_s3(args.s3_public_url)[0] if args.s3_public_url else s3
 
     # ensure bucket exists
     if bucket not in [b['Name'] for b in s3.list_buckets()['Buckets']]:
@@ -78,18 +227,37 @@ def main():
         s3.create_bucket(Bucket=bucket)
 
     # set up providers
-    providers = {"apt": AptProvider(dbcon, s3, bucket),
-                 "pypi": PypiProvider(dbcon, s3, bucket),
-                 "tar": TarProvider(dbcon, s3, bucket)}
+    blobcache = None
+    if args.blob_cache_dir:
+        blobcache = BlobCache(args.blob_cache_dir, args.blob_cache_size * 1024 * 1024,
+                              accel_prefix=args.blob_cache_accel_prefix)
+    blobs = {name: BlobStore(s3, bucket, mode=mode, presign_client=presign_s3, url_expires=args.download_url_expires,
+                             accel_prefix=args.accel_prefix, cache=blobcache,
+                             part_size=args.upload_part_size * 1024 * 1024,
+                             upload_concurrency=args.upload_concurrency)
+             for name, mode in download_modes.items()}
+    publisher = Publisher(s3, bucket) if args.publish else None
+    providers = {"apt": AptProvider(dbcon, s3, bucket, regen_workers=args.regen_workers,
+                                    regen_delay=args.regen_delay,
+                                    cache_size=args.metadata_cache_size * 1024 * 1024,
+                                    blobs=blobs["apt"], publisher=publisher,
+                                    archs=[arch.strip() for arch in args.apt_archs.split(",") if arch.strip()]),
+                 "pypi": PypiProvider(dbcon, s3, bucket, cache_size=args.metadata_cache_size * 1024 * 1024,
+                                      blobs=blobs["pypi"], publisher=publisher),
+                 "tar": TarProvider(dbcon, s3, bucket, blobs=blobs["tar"])}
+
+    metrics.REGISTRY.register(metrics.ServerCollector(providers))
 
     # set up main web screen
-    web = AppWeb(providers)
+    web = AppWeb(providers, blobcache=blobcache)
 
     cherrypy.tree.mount(web, '/', {'/': {'tools.trailing_slash.on': False,
                                          'tools.db.on': True}})
 
     cherrypy.config.update({
         'tools.sessions.on': False,
+        'tools.metrics.on': True,
+        'tools.tracing.on': True,
         'request.show_tracebacks': True,
         'server.socket_port': args.port,
         'server.thread_pool': 5,
@@ -0,0 +1,101 @@
+import pgpy
+import time
+import traceback
+from contextlib import ExitStack
+from datetime import datetime
+from pgpy.constants import PubKeyAlgorithm, KeyFlags, HashAlgorithm, SymmetricKeyAlgorithm, CompressionAlgorithm
+from queue import Queue
+from threading import Lock, Thread
+
+
+"""stored secret keys are protected with this passphrase"""
+KEY_PASSPHRASE = "secret"
+KEY_NAME = "Autogenerated Key"
+KEY_EMAIL = "debian_signing@localhost"
+KEY_EXPIRES = datetime(2029, 4, 28)
+
+
+def generate_key(key_length=4096):
+    """
+    Generate a new passphrase protected RSA signing key
+    """
+    key = pgpy.PGPKey.new(PubKeyAlgorithm.RSAEncryptOrSign, key_length)
+    key.add_uid(pgpy.PGPUID.new(KEY_NAME, email=KEY_EMAIL),
+                usage={KeyFlags.Sign, KeyFlags.EncryptCommunications, KeyFlags.EncryptStorage, KeyFlags.Authentication},
+                hashes=[HashAlgorithm.SHA512, HashAlgorithm.SHA384, HashAlgorithm.SHA256],
+                ciphers=[SymmetricKeyAlgorithm.AES256, SymmetricKeyAlgorithm.AES192, SymmetricKeyAlgorithm.AES128],
+                compression=[CompressionAlgorithm.ZLIB, CompressionAlgorithm.Uncompressed],
+                key_expiration=KEY_EXPIRES - datetime.utcnow())
+    key.protect(KEY_PASSPHRASE, SymmetricKeyAlgorithm.AES256, HashAlgorithm.SHA256)
+    return key
+
+
+def key_fingerprint(key):
+    return str(key.fingerprint).replace(" ", "")
+
+
+class SigningService(object):
+    def __init__(self, spare_keys=1, key_length=4096):
+        """
+        Signs data with repo keys that are decrypted once and then kept in memory, and hands out new keys that were
+        generated ahead of time in the background. `spare_keys` is how many pregenerated keys to keep on hand.
+        """
+        self.spare_keys = spare_keys
+        self.key_length = key_length
+        self.lock = Lock()
+        """fingerprint -> (unlocked PGPKey, ExitStack holding it unlocked)"""
+        self.keys = {}
+
+        if spare_keys > 0:
+            self.spares = Queue(maxsize=spare_keys)
+            self.generator = Thread(target=self._pregenerate, daemon=True)
+            self.generator.start()
+
+    def _pregenerate(self):
+        while True:
+            try:
+                self.spares.put(generate_key(self.key_length))
+            except Exception:
+                traceback.print_exc()
+                time.sleep(60)
+
+    def new_key(self):
+        """
+        Return a new key as a tuple of (armored secret key, fingerprint, armored public key)
+        """
+        key = self.spares.get() if self.spare_keys > 0 else generate_key(self.key_length)
+        return str(key), key_fingerprint(key), str(key.pubkey)
+
+    def _get_key(self, armored, fingerprint):
+        with self.lock:
+            if fingerprint not in self.keys:
+                key, _ = pgpy.PGPKey.from_blob(armored)
+                assert(key_fingerprint(key) == fingerprint), "stored key does not match its fingerprint"
+                unlocked = ExitStack()
+                if key.is_protected:
+                    unlocked.enter_context(key.unlock(KEY_PASSPHRASE))
+                self.keys[fingerprint] = (key, unlocked)
+            return self.keys[fingerprint][0]
+
+    def forget(self, fingerprint):
+        """
+        Drop a key from memory
+        """
+        with self.lock:
+            key, unlocked = self.keys.pop(fingerprint, (None, None))
+        if unlocked:
+            unlocked.close()
+
+    def sign(self, armored, fingerprint, data):
+        """
+        Return an armored detached signature of `data` made with the given key
+        """
+        return str(self._get_key(armored, fingerprint).sign(data))
+
+    def clearsign(self, armored, fingerprint, text):
+        """
+        Return `text` as a clearsigned document signed with the given key
+        """
+        message = pgpy.PGPMessage.new(text, cleartext=True)
+        message |= self._get_key(armored, fingerprint).sign(message)
+        return str(message)
@@ -1,27 +1,211 @@
+import re
 import sqlalchemy
 import cherrypy
 from cherrypy.process import plugins
+from sqlalchemy import func
+from sqlalchemy.exc import DBAPIError, IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.schema import CreateColumn
 
 
 Base = declarative_base()
 
 
+"""table name -> names of columns added to it since it was first created, see added_columns()"""
+_added_columns = {}
+"""table name -> names of indexes added to it since it was first created, see added_indexes()"""
+_added_indexes = {}
+
+
+"""requests with these methods are handled read only, on the replica database if there is one"""
+READ_METHODS = ("GET", "HEAD")
+
+
 def db():
     return cherrypy.request.db
 
 
+def db_primary():
+    """
+    Return a session on the primary database. Read requests get a session on the replica from db(); those that need to
+    write anyway use this one instead, which is then committed at the end of the request as usual.
+    """
+    request = cherrypy.request
+    request.db_primary_used = True
+    return request.db_primary
+
+
+def get_or_create(_db, model, create_ok=True, **keys):
+    """
+    Fetch the row of `model` with the column values `keys`, creating and committing it if there is none and `create_ok`
+    is set. A concurrent request may create the same row first, in which case its row is used.
+    """
+    row = _db.query(model).filter_by(**keys).first()
+    if not row and create_ok:
+        try:
+            row = model(**keys)
+            _db.add(row)
+            _db.commit()
+        except IntegrityError:
+            _db.rollback()
+            row = _db.query(model).filter_by(**keys).one()
+    return row
+
+
+# https://stackoverflow.com/a/5967539
+def sort_atoi(text):
+    return int(text) if text.isdigit() else text
+
+
+def natural_keys(text):
+    """
+    Sort keeping keys in "natural" order such that version names embedded in strings are ordered correctly such as:
+    - macosx_10_6_intel
+    - macosx_10_9_intel
+    - macosx_10_9_x86_64
+    - macosx_10_10_intel
+    - macosx_10_10_x86_64
+    """
+    return [sort_atoi(c) for c in re.split(r'(\d+)', text)]
+
+
+class ProjectTable(object):
+    def __init__(self, package, project, key, copy=(), touch=None):
+        """
+        Maintains a provider's project rows, one per distinct name in a repo, so that listing a repo's projects doesn't
+        have to scan all of its packages. `package` and `project` are the models of the packages and of their projects,
+        which share the name column `key` and each have a `repo_id` and `version`/`latest`. Columns named in `copy` are
+        copied to the project from its latest package. `touch(db, repo)`, if given, is called when projects change.
+        """
+        self.package = package
+        self.project = project
+        self.key = key
+        self.copy = copy
+        self.touch = touch
+
+    def refresh(self, _db, repo, name):
+        """
+        Recalculate a project's package count and latest version, creating or removing its row as needed
+        """
+        versions = _db.query(self.package.version, *[getattr(self.package, column) for column in self.copy]) \
+            .filter(self.package.repo_id == repo.id, getattr(self.package, self.key) == name).all()
+        project = _db.query(self.project) \
+            .filter(self.project.repo_id == repo.id, getattr(self.project, self.key) == name).first()
+
+        if not versions:
+            if project:
+                _db.delete(project)
+            return
+
+        if not project:
+            project = self.project(repo_id=repo.id, **{self.key: name})
+            _db.add(project)
+        latest = max(versions, key=lambda row: natural_keys(row.version))
+        project.count = len(versions)
+        project.latest = latest.version
+        for column in self.copy:
+            setattr(project, column, getattr(latest, column))
+
+    def update(self, _db, repo, *names):
+        """
+        Refresh projects after their packages have changed and commit. A concurrent upload may create the same new
+        project first, in which case we try again against its row.
+        """
+        for attempt in range(2):
+            try:
+                for name in names:
+                    self.refresh(_db, repo, name)
+                if self.touch:
+                    self.touch(_db, repo)
+                _db.commit()
+                return
+            except IntegrityError:
+                _db.rollback()
+                if attempt:
+                    raise
+
+    def sync(self, _db, repo):
+        """
+        Bring a repo's project rows in line with its packages, for instance when projects have not yet been recorded
+        for packages that were uploaded before they existed
+        """
+        key = getattr(self.package, self.key)
+        counts = dict(_db.query(key, func.count(self.package.id))
+                      .filter(self.package.repo_id == repo.id).group_by(key).all())
+        recorded = dict(_db.query(getattr(self.project, self.key), self.project.count)
+                        .filter(self.project.repo_id == repo.id).all())
+
+        stale = [name for name in set(counts.keys()) | set(recorded.keys()) if counts.get(name) != recorded.get(name)]
+        if stale:
+            print(f"refreshing {len(stale)} projects in {repo.name}")
+            for name in stale:
+                self.refresh(_db, repo, name)
+            if self.touch:
+                self.touch(_db, repo)
+            _db.commit()
+
+
+def added_columns(model, *names):
+    """
+    Register columns that were added to `model`'s table after it was first created. create_all() only creates missing
+    tables, so these are added to tables that already exist by migrate() when the server starts. Columns that can't be
+    null need a server_default to fill in the existing rows.
+    """
+    _added_columns.setdefault(model.__tablename__, []).extend(names)
+
+
+def added_indexes(model, *names):
+    """
+    Register indexes, by name, that were added to `model`'s table after it was first created. Like added_columns(),
+    migrate() creates them on tables that already exist.
+    """
+    _added_indexes.setdefault(model.__tablename__, []).extend(names)
+
+
+def migrate(engine):
+    """
+    Add registered columns and indexes that are missing from the database's tables. Does nothing if they are all there
+    already, and copes with other servers migrating the same database at the same time.
+    """
+    for table in Base.metadata.sorted_tables:
+        for name in _added_columns.get(table.name, ()):
+            existing = {column["name"] for column in sqlalchemy.inspect(engine).get_columns(table.name)}
+            if name in existing:
+                continue
+            ddl = "ALTER TABLE {} ADD COLUMN {}".format(engine.dialect.identifier_preparer.format_table(table),
+                                                        CreateColumn(table.c[name]).compile(dialect=engine.dialect))
+            try:
+                with engine.begin() as conn:
+                    conn.execute(ddl)
+            except DBAPIError:
+                # another server may have added it first
+                if name not in {column["name"] for column in sqlalchemy.inspect(engine).get_columns(table.name)}:
+                    raise
+
+        indexes = {index.name: index for index in table.indexes}
+        for name in _added_indexes.get(table.name, ()):
+            if name in {index["name"] for index in sqlalchemy.inspect(engine).get_indexes(table.name)}:
+                continue
+            try:
+                indexes[name].create(engine)
+            except DBAPIError:
+                if name not in {index["name"] for index in sqlalchemy.inspect(engine).get_indexes(table.name)}:
+                    raise
+
+
 class SAEnginePlugin(plugins.SimplePlugin):
-    def __init__(self, bus, dbcon):
+    def __init__(self, bus, dbcon, replica=None):
         plugins.SimplePlugin.__init__(self, bus)
         self.sa_engine = dbcon
+        self.replica_engine = replica or dbcon
         self.bus.subscribe("bind", self.bind)
 
     def start(self):
         Base.metadata.create_all(self.sa_engine)
+        migrate(self.sa_engine)
 
-    def bind(self, session):
-        session.configure(bind=self.sa_engine)
+    def bind(self, session, readonly=False):
+        session.configure(bind=self.replica_engine if readonly else self.sa_engine)
 
 
 class SATool(cherrypy.Tool):
@@ -37,6 +221,9 @@ class SATool(cherrypy.Tool):
         This tools binds a session to the engine each time
         a requests starts and commits/rollbacks whenever
         the request terminates.
+
+        Read requests are given a session on the replica
+        engine instead, which is never committed.
         """
         cherrypy.Tool.__init__(self, 'before_request_body',
                                self.bind_session,
@@ -44,22 +231,36 @@ class SATool(cherrypy.Tool):
 
         self.session = sqlalchemy.orm.scoped_session(
             sqlalchemy.orm.sessionmaker(autoflush=True, autocommit=False))
+        self.read_session = sqlalchemy.orm.scoped_session(
+            sqlalchemy.orm.sessionmaker(autoflush=False, autocommit=False))
 
     def _setup(self):
         cherrypy.Tool._setup(self)
         cherrypy.request.hooks.attach('on_end_resource', self.commit_transaction, priority=80)
 
     def bind_session(self):
+        # stale connections are weeded out by the pool's pre-ping
+        request = cherrypy.request
         cherrypy.engine.publish('bind', self.session)
-        cherrypy.request.db = self.session
-        cherrypy.request.db.connection().connection.connection.ping()
+        request.db_primary = self.session
+        request.db_primary_used = False
+        request.db_readonly = request.method in READ_METHODS
+        if request.db_readonly:
+            cherrypy.engine.publish('bind', self.read_session, True)
+            request.db = self.read_session
+        else:
+            request.db = self.session
 
     def commit_transaction(self):
-        cherrypy.request.db = None
+        request = cherrypy.request
+        request.db = None
         try:
-            self.session.commit()
+            if not request.db_readonly or request.db_primary_used:
+                self.session.commit()
         except Exception:
             self.session.rollback()
             raise
         finally:
             self.session.remove()
+            if request.db_readonly:
+                self.read_session.remove()
@@ -1,13 +1,15 @@
 import cherrypy
-import hashlib
 import json
 import os
 from jinja2 import Environment, FileSystemLoader, select_autoescape
-from sqlalchemy import Column, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 from sqlalchemy.types import String, Integer
-from tempfile import TemporaryDirectory
-from repobot.tables import Base, db
+from repobot.blobs import BlobStore
+from repobot.ingest import committing, copyhash
+from repobot.metrics import set_route
+from repobot.tables import Base, ProjectTable, added_indexes, db, db_primary, get_or_create
+from repobot.tracing import span
 
 
 APPROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "../"))
@@ -34,7 +36,8 @@ class TarPackage(Base):
     size = Column(Integer, nullable=False)
     sha256 = Column(String(length=64))
 
-    __table_args__ = (UniqueConstraint('fname', 'repo_id', name='tar_unique_repopkg'), )
+    __table_args__ = (UniqueConstraint('fname', 'repo_id', name='tar_unique_repopkg'),
+                      Index('tar_repo_name', 'repo_id', 'name'), )
 
     @property
     def blobpath(self):
@@ -42,91 +45,136 @@ class TarPackage(Base):
         Get the s3 path within
         repos/<reponame>/tarballs/<f>/<foo>/<foo-1.2.3.tar.gz>
         """
-        return os.path.join("repos", self.repo.name, "tarballs", self.fname[0].lower(), self.name, self.fname)
+        return tarball_blobpath(self.repo.name, self.name, self.fname)
 
 
-def get_repo(_db, repo_name, create_ok=True):  #TODO make this generic
+added_indexes(TarPackage, "tar_repo_name")
+
+
+def tarball_blobpath(reponame, name, fname):
     """
-    Fetch a repo from the database by name
+    Return the path of a tarball within the provider's s3 base path, repos/<reponame>/tarballs/f/foo/foo-1.2.3.tar.gz
     """
-    repo = _db.query(TarRepo).filter(TarRepo.name == repo_name).first()
-    if not repo and create_ok:
-        repo = TarRepo(name=repo_name)
-        _db.add(repo)
-        _db.commit()
-    return repo
+    return os.path.join("repos", reponame, "tarballs", fname[0].lower(), name, fname)
+
+
+class TarProject(Base):
+    """
+    One row per distinct package name in a repo, kept up to date by `projects`
+    """
+    __tablename__ = 'tarproject'
+    id = Column(Integer, primary_key=True)
+
+    repo_id = Column(Integer, ForeignKey("tarrepo.id"), nullable=False)
+    repo = relationship("TarRepo")
+
+    name = Column(String(length=128), nullable=False)       # 'cpython'
+    count = Column(Integer, nullable=False)                 # number of tarballs
+    latest = Column(String(length=64), nullable=False)      # '3.7.3'
+
+    __table_args__ = (UniqueConstraint('repo_id', 'name', name='tar_unique_repoproject'), )
 
 
-def copysha256(fin, fout):
+def get_repo(_db, repo_name, create_ok=True):
     """
-    Copy a file and calculate sha256 while doing so
+    Fetch a repo from the database by name
     """
-    h = hashlib.sha256()
+    return get_or_create(_db, TarRepo, create_ok, name=repo_name)
 
-    while True:
-        data = fin.read(4096)
-        if not data:
-            break
-        h.update(data)
-        fout.write(data)
 
-    return h.hexdigest()
+projects = ProjectTable(TarPackage, TarProject, "name")
 
 
 class TarProvider(object):
-    def __init__(self, dbcon, s3client, bucket):
+    def __init__(self, dbcon, s3client, bucket, blobs=None):
         self.db = dbcon
         self.s3 = s3client
         self.bucket = bucket
         """base path within the s3 bucket"""
         self.basepath = "data/provider/tar"
+        """answers package downloads"""
+        self.blobs = blobs or BlobStore(s3client, bucket)
+        """ids of repos whose projects have been checked against their tarballs since startup"""
+        self.synced = set()
 
         cherrypy.tree.mount(TarWeb(self), "/repo/tar", {'/': {'tools.trailing_slash.on': False,
                                                               'tools.db.on': True}})
 
+    def _ingest(self, repo, name, version, fobj, pending=()):
+        """
+        Stream a tarball to s3, returning its row, not yet added to the session, and its s3 path. `pending` holds the
+        file names of tarballs that are about to be added alongside it.
+        """
+        #TODO assert that the uploaded file smells like a tarball
+        #TODO assert the version string matches allowed chars
+        #TODO assert the name string matches allowed chars
+        #TODO support non-gzip
+        fname = f"{name}-{version}.tar.gz"
+        assert(fname not in pending and
+               not db().query(TarPackage).filter(TarPackage.repo == repo, TarPackage.fname == fname).first()), \
+            f"{fname} already exists in {repo.name}"
+
+        tar = TarPackage(repo=repo,
+                         name=name,
+                         version=version,
+                         fname=fname)
+
+        # s3 path - repos/<reponame>/tarballs/f/foo/foo-1234.tar.gz
+        dpath = os.path.join(self.basepath, tar.blobpath)
+
+        files = self.s3.list_objects(Bucket=self.bucket, Prefix=dpath).get("Contents")
+        if files:
+            print(f"will overwrite: {files}")
+
+        # the upload is streamed straight to s3 as it is received
+        upload = self.blobs.upload(dpath)
+        try:
+            with span("copy"):
+                hashes, tar.size = copyhash(fobj.file, [upload])
+            tar.sha256 = hashes["sha256"]
+            with span("write"):
+                upload.close()
+        except Exception:
+            upload.abort()
+            raise
+        return tar, dpath
+
     def web_addpkg(self, reponame, name, version, fobj):
+        assert(name and version), "tarballs need a name and version"
         repo = get_repo(db(), reponame)
+        tar, dpath = self._ingest(repo, name, version, fobj)
 
-        # write wheel to temp storage
-        with TemporaryDirectory() as tdir:
-            tmppkgpath = os.path.join(tdir, fobj.filename)  #TODO verify filename doesnt have any nonsense like ../../passwd
-            with open(tmppkgpath, "wb") as fdest:
-                shasum = copysha256(fobj.file, fdest)
-
-            #TODO assert that the uploaded file smells like a tarball
-            #TODO assert the version string matches allowed chars
-            #TODO assert the name string matches allowed chars
-            #TODO support non-gzip
-            fname = f"{name}-{version}.tar.gz"
-
-            # add to db
-            tar = TarPackage(repo=repo,
-                             name=name,
-                             version=version,
-                             fname=fname,
-                             size=os.path.getsize(tmppkgpath),
-                             sha256=shasum)
-
-            # s3 path - repos/<reponame>/tarballs/f/foo/foo-1234.tar.gz
-            dpath = os.path.join(self.basepath, tar.blobpath)
-
-            files = self.s3.list_objects(Bucket=self.bucket, Prefix=dpath).get("Contents")
-            if files:
-                print(f"will overwrite: {files}")
-
+        with committing(db(), self.s3, self.bucket, [dpath]):
             db().add(tar)
-            db().commit()
 
-            try:
-                with open(tmppkgpath, "rb") as f:
-                    response = self.s3.put_object(Body=f, Bucket=self.bucket, Key=dpath)
-                    assert(response["ResponseMetadata"]["HTTPStatusCode"] == 200), f"Upload failed: {response}"
-            except Exception:
-                db().delete(tar)
-                db().commit()
-                raise
+        projects.update(db(), repo, name)
+
+        return json.dumps({"ok": True}, indent=4)  #TODO do something with this
 
-            return json.dumps({"ok": True}, indent=4)  #TODO do something with this
+    def web_addpkgs(self, reponame, uploads):
+        """
+        Add many tarballs to a repo, committing them together once all have been stored. `uploads` yields
+        (file, params) for each tarball, where params are those of web_addpkg. If any tarball fails, none are added.
+        """
+        repo = get_repo(db(), reponame)
+        tars = []
+        fnames = set()
+        dpaths = []
+        names = set()
+        with committing(db(), self.s3, self.bucket, dpaths):
+            for fobj, params in uploads:
+                assert(params.get("name") and params.get("version")), f"{fobj.filename} needs a name and version"
+                tar, dpath = self._ingest(repo, params["name"], params["version"], fobj, pending=fnames)
+                tars.append(tar)
+                fnames.add(tar.fname)
+                dpaths.append(dpath)
+                names.add(tar.name)
+
+            db().add_all(tars)
+
+        projects.update(db(), repo, *names)
+
+        return json.dumps({"ok": True, "added": sorted(fnames)}, indent=4)
 
 
 @cherrypy.popargs("reponame", "pkgname", "filename")
@@ -146,64 +194,65 @@ class TarWeb(object):
             return self.handle_navigation(reponame, pkgname, filename)
 
     def handle_navigation(self, reponame=None, pkgname=None, filename=None):
+        set_route("package" if pkgname else "repo" if reponame else "root")
         if reponame:
             repo = get_repo(db(), reponame, create_ok=False)
+            if not repo:
+                raise cherrypy.HTTPError(404)
             if pkgname:
                 return self.tpl.get_template("tar/package.html") \
                     .render(repo=repo,
-                            pkgs=db().query(TarPackage).filter(TarPackage.repo == repo,
-                                                               TarPackage.name == pkgname).
-                            order_by(TarPackage.version).all())
+                            pkgs=db().query(TarPackage.name, TarPackage.fname, TarPackage.sha256)
+                            .filter(TarPackage.repo_id == repo.id,
+                                    TarPackage.name == pkgname)
+                            .order_by(TarPackage.version).all())
+
+            if repo.id not in self.base.synced:
+                projects.sync(db_primary(), repo)
+                self.base.synced.add(repo.id)
 
             return self.tpl.get_template("tar/repo.html") \
                 .render(repo=repo,
-                        pkgs=self._get_dists(repo))
+                        pkgs=db().query(TarProject.name).filter(TarProject.repo_id == repo.id)
+                        .order_by(TarProject.name).all())
 
         return self.tpl.get_template("tar/root.html") \
-            .render(repos=db().query(TarRepo).order_by(TarRepo.name).all())
-
-    def _get_dists(self, repo):
-        lastpkg = None
-        for pkg in db().query(TarPackage).filter(TarPackage.repo == repo).order_by(TarPackage.fname).all():
-            if lastpkg and pkg.name == lastpkg:
-                continue
-            yield pkg
-            lastpkg = pkg.name
+            .render(repos=db().query(TarRepo.name).order_by(TarRepo.name).all())
 
     def handle_download(self, reponame, distname, filename):
+        method = str(cherrypy.request.method)
+        if method == "DELETE":
+            set_route("delete")
+            return self.handle_delete(reponame, filename)
+        elif method not in ("GET", "HEAD"):
+            raise cherrypy.HTTPError(405)
+        set_route("download")
+
+        pkg = db().query(TarRepo.name.label("repo"), TarPackage.name, TarPackage.fname, TarPackage.size,
+                         TarPackage.sha256) \
+            .join(TarRepo, TarPackage.repo_id == TarRepo.id) \
+            .filter(TarRepo.name == reponame,
+                    TarPackage.fname == filename).first()
+        if not pkg:
+            raise cherrypy.HTTPError(404)
+
+        dpath = os.path.join(self.base.basepath, tarball_blobpath(pkg.repo, pkg.name, pkg.fname))
+        return self.base.blobs.serve(dpath, "application/octet-stream", pkg.size, sha256=pkg.sha256, immutable=True)
+
+    def handle_delete(self, reponame, filename):
         repo = get_repo(db(), reponame, create_ok=False)
         pkg = db().query(TarPackage).filter(TarPackage.repo == repo, TarPackage.fname == filename).first()
         if not pkg:
             raise cherrypy.HTTPError(404)
 
         dpath = os.path.join(self.base.basepath, pkg.blobpath)
-        print("dpath=", dpath)
-        print("blobpath=", pkg.blobpath)
-        print("basepath=", self.base.basepath)
-
-        if str(cherrypy.request.method) == "DELETE":
-            db().delete(pkg)
-            files = self.base.s3.list_objects(Bucket=self.base.bucket, Prefix=dpath).get("Contents")
-            if files:
-                self.base.s3.delete_object(Bucket=self.base.bucket, Key=dpath)
-            db().commit()
-            return "OK"  #TODO delete the repo if we've emptied it(?)
-
-        elif str(cherrypy.request.method) == "GET":
-            response = self.base.s3.get_object(Bucket=self.base.bucket, Key=dpath)
-
-            cherrypy.response.headers["Content-Type"] = "application/octet-stream"
-            cherrypy.response.headers["Content-Length"] = response["ContentLength"]
-
-            def stream():
-                while True:
-                    data = response["Body"].read(65535)
-                    if not data:
-                        return
-                    yield data
-
-            return stream()
-        else:
-            raise cherrypy.HTTPError(405)
+        name = pkg.name
+        db().delete(pkg)
+        files = self.base.s3.list_objects(Bucket=self.base.bucket, Prefix=dpath).get("Contents")
+        if files:
+            self.base.s3.delete_object(Bucket=self.base.bucket, Key=dpath)
+        db().commit()
+        projects.update(db(), repo, name)
+        return "OK"  #TODO delete the repo if we've emptied it(?)
 
     index._cp_config = {'response.stream': True}
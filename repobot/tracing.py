@@ -0,0 +1,254 @@
+import cherrypy
+import logging
+import time
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from threading import local
+
+
+"""traces taking at least this many seconds are logged with their span tree, if set"""
+slow_threshold = None
+
+log = logging.getLogger("repobot.slow")
+
+_local = local()
+
+
+class Span(object):
+    __slots__ = ("name", "count", "seconds", "started", "children")
+
+    def __init__(self, name):
+        """
+        All the times a piece of work named `name` was done within the same parent span. Work done in a loop is
+        recorded as one span with a count, which keeps traces of large uploads small.
+        """
+        self.name = name
+        self.count = 0
+        self.seconds = 0.0
+        """when the span was last started, while it is running"""
+        self.started = None
+        """name -> child span, in the order they first ran"""
+        self.children = {}
+
+    @property
+    def duration(self):
+        if self.started is None:
+            return self.seconds
+        return self.seconds + time.perf_counter() - self.started
+
+
+class Trace(object):
+    def __init__(self, name):
+        """
+        The tree of timed spans of one request or background job, built on the thread running it. Span times are also
+        summed by name, which is what the Server-Timing header reports.
+        """
+        self.root = Span(name)
+        self.root.started = time.perf_counter()
+        self.stack = [self.root]
+        """name -> [count, seconds]"""
+        self.totals = {}
+
+    def start(self, name):
+        parent = self.stack[-1]
+        span = parent.children.get(name)
+        if span is None:
+            span = parent.children[name] = Span(name)
+        span.started = time.perf_counter()
+        self.stack.append(span)
+        return span
+
+    def finish(self, span):
+        if span.started is None or span not in self.stack:
+            return
+        # spans left running inside this one, such as by an exception, finish along with it
+        while True:
+            top = self.stack.pop()
+            self._stop(top)
+            if top is span:
+                break
+
+    def _stop(self, span):
+        elapsed = time.perf_counter() - span.started
+        span.started = None
+        span.count += 1
+        span.seconds += elapsed
+        total = self.totals.setdefault(span.name, [0, 0.0])
+        total[0] += 1
+        total[1] += elapsed
+
+    def close(self):
+        while len(self.stack) > 1:
+            self._stop(self.stack.pop())
+        self.stack = []
+        self.root.seconds = self.root.duration
+        self.root.started = None
+
+    def server_timing(self):
+        """
+        Return the value of a Server-Timing header listing the total time spent in each kind of span, longest first
+        """
+        entries = ["total;dur={:.1f}".format(self.root.duration * 1000)]
+        for name, (count, seconds) in sorted(self.totals.items(), key=lambda item: -item[1][1]):
+            entry = "{};dur={:.1f}".format(name, seconds * 1000)
+            if count > 1:
+                entry += ';desc="{}x"'.format(count)
+            entries.append(entry)
+        return ", ".join(entries)
+
+    def format(self):
+        """
+        Render the span tree as text, one span per line
+        """
+        lines = []
+
+        def render(span, depth):
+            line = "{}{} {:.1f}ms".format("  " * depth, span.name, span.duration * 1000)
+            if span.count > 1:
+                line += " x{}".format(span.count)
+            lines.append(line)
+            for child in span.children.values():
+                render(child, depth + 1)
+
+        render(self.root, 0)
+        return "\n".join(lines)
+
+
+def begin(name):
+    """
+    Start tracing the work done on this thread
+    """
+    _local.trace = Trace(name)
+    return _local.trace
+
+
+def end():
+    """
+    Stop tracing on this thread and return the trace, logging it if it was slow
+    """
+    trace = getattr(_local, "trace", None)
+    _local.trace = None
+    if trace is None:
+        return None
+    trace.close()
+    if slow_threshold is not None and trace.root.seconds >= slow_threshold:
+        log.warning("slow: %s", trace.format())
+    return trace
+
+
+def current():
+    return getattr(_local, "trace", None)
+
+
+def start(name):
+    """
+    Start a span in this thread's trace, if it has one. The span must be passed to finish().
+    """
+    trace = getattr(_local, "trace", None)
+    return trace.start(name) if trace is not None else None
+
+
+def finish(span):
+    trace = getattr(_local, "trace", None)
+    if span is not None and trace is not None:
+        trace.finish(span)
+
+
+@contextmanager
+def span(name):
+    """
+    Time the enclosed block as a span of this thread's trace. Does nothing on threads that aren't being traced.
+    """
+    s = start(name)
+    try:
+        yield s
+    finally:
+        finish(s)
+
+
+class TracingTool(cherrypy.Tool):
+    def __init__(self):
+        """
+        Traces every request, answering with a Server-Timing header summarizing where its time went. The header is
+        added once the response has been finalized, which is when the bodies of non-streamed responses are produced,
+        and after the database session has been committed. The time taken to send a streamed body isn't included in
+        the header, but is in the slow request log. Reading a request body cherrypy processes itself, such as spooling
+        a multipart form to a temp file, is the "body" span.
+        """
+        cherrypy.Tool.__init__(self, 'on_start_resource', self.begin_request, priority=5)
+
+    def _setup(self):
+        cherrypy.Tool._setup(self)
+        cherrypy.request.hooks.attach('before_request_body', self.begin_body, priority=95)
+        cherrypy.request.hooks.attach('before_handler', self.end_body, priority=5)
+        cherrypy.request.hooks.attach('on_end_resource', self.add_header, priority=90)
+        cherrypy.request.hooks.attach('on_end_request', self.end_request, priority=95)
+
+    def begin_request(self):
+        request = cherrypy.request
+        begin("{} {}{}".format(request.method, request.script_name, request.path_info))
+
+    def begin_body(self):
+        cherrypy.request.trace_body = start("body")
+
+    def end_body(self):
+        finish(getattr(cherrypy.request, "trace_body", None))
+
+    def add_header(self):
+        trace = current()
+        if trace is None:
+            return
+        value = trace.server_timing()
+        response = cherrypy.response
+        response.headers["Server-Timing"] = value
+        if response.header_list is not None:
+            response.header_list.append((b"Server-Timing", value.encode("ISO-8859-1")))
+
+    def end_request(self):
+        end()
+
+
+def _before_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info["trace_span"] = start("db")
+
+
+def _after_query(conn, cursor, statement, parameters, context, executemany):
+    finish(conn.info.pop("trace_span", None))
+
+
+def _before_commit(session):
+    session.info["trace_span"] = start("db.commit")
+
+
+def _after_commit(session):
+    finish(session.info.pop("trace_span", None))
+
+
+def instrument_engine(engine):
+    """
+    Trace queries made through the sqlalchemy `engine`, and session commits
+    """
+    event.listen(engine, "before_cursor_execute", _before_query)
+    event.listen(engine, "after_cursor_execute", _after_query)
+    if not event.contains(Session, "before_commit", _before_commit):
+        event.listen(Session, "before_commit", _before_commit)
+        event.listen(Session, "after_commit", _after_commit)
+        event.listen(Session, "after_rollback", _after_commit)
+
+
+def _before_s3(model, context, **kwargs):
+    context["trace_span"] = start("s3." + model.name)
+
+
+def _after_s3(context, **kwargs):
+    finish(context.pop("trace_span", None))
+
+
+def instrument_s3(client):
+    """
+    Trace calls made with the boto3 s3 `client`
+    """
+    client.meta.events.register("before-call.s3", _before_s3)
+    client.meta.events.register("after-call.s3", _after_s3)
+    client.meta.events.register("after-call-error.s3", _after_s3)
@@ -0,0 +1,87 @@
+from concurrent.futures import ThreadPoolExecutor
+from repobot.tracing import span
+
+
+"""default size of the parts large uploads are sent to s3 in; s3 requires at least 5MB for all but the last part"""
+PART_SIZE = 8 * 1024 * 1024
+
+
+class S3Upload(object):
+    def __init__(self, s3client, bucket, key, part_size=PART_SIZE, concurrency=4):
+        """
+        File-like writer that streams data into an s3 object. Data is buffered until `part_size` bytes are available
+        and then sent as one part of a multipart upload, with up to `concurrency` parts being sent at once. Uploads
+        that are smaller than one part are sent with a single put_object call instead.
+        """
+        self.s3 = s3client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.buf = bytearray()
+        self.upload_id = None
+        self.pool = None
+        """futures of parts being sent, oldest first"""
+        self.pending = []
+        self.parts = []
+        self.next_part = 1
+
+    def write(self, data):
+        self.buf += data
+        while len(self.buf) >= self.part_size:
+            part = bytes(self.buf[:self.part_size])
+            del self.buf[:self.part_size]
+            self._upload_part(part)
+
+    def _upload_part(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key)["UploadId"]
+            self.pool = ThreadPoolExecutor(max_workers=self.concurrency)
+
+        # bound memory use by waiting for the oldest part before sending another. parts are sent on other threads,
+        # so waiting on them is all a trace of the request sees.
+        with span("s3.parts"):
+            while len(self.pending) >= self.concurrency:
+                self.parts.append(self.pending.pop(0).result())
+
+        self.pending.append(self.pool.submit(self._send_part, self.next_part, data))
+        self.next_part += 1
+
+    def _send_part(self, number, data):
+        response = self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                       PartNumber=number, Body=data)
+        return {"ETag": response["ETag"], "PartNumber": number}
+
+    def close(self):
+        """
+        Finish the upload, making the object visible
+        """
+        if self.upload_id is None:
+            response = self.s3.put_object(Body=bytes(self.buf), Bucket=self.bucket, Key=self.key)
+            assert(response["ResponseMetadata"]["HTTPStatusCode"] == 200), f"Upload failed: {response}"
+        else:
+            if self.buf:
+                self._upload_part(bytes(self.buf))
+            with span("s3.parts"):
+                while self.pending:
+                    self.parts.append(self.pending.pop(0).result())
+            self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                              MultipartUpload={"Parts": sorted(self.parts,
+                                                                               key=lambda p: p["PartNumber"])})
+            self.upload_id = None
+            self.pool.shutdown()
+        self.buf = bytearray()
+
+    def abort(self):
+        """
+        Discard the upload and any parts already sent. Does nothing once the upload has been completed.
+        """
+        self.buf = bytearray()
+        if self.upload_id is not None:
+            for future in self.pending:
+                future.cancel()
+            self.pool.shutdown(wait=True)
+            self.pending = []
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+